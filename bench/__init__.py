@@ -0,0 +1,190 @@
+# Author: Eric Kow
+# License: BSD3
+
+"""
+Performance benchmarks for educe
+
+These are not tests: they do not check that anything is correct, only
+how long things take and how much memory they use, so that we can spot
+regressions from one commit to the next. Run a suite from the top of
+the repository, eg. ::
+
+    python -m bench.glozz_io --output bench-results.json
+
+Each run appends a record (git revision, date, python version, and one
+set of measurements per case) to the JSON file, so the same file can
+accumulate results for many commits. Use `python -m bench.compare` to
+compare the two most recent runs of a file (or two separate files).
+
+Each case is measured in a freshly forked process, so that the memory
+figures for one case are not polluted by the ones before it.
+
+Measurements
+~~~~~~~~~~~~
+* seconds:      best wall clock time over the repeats
+* mean_seconds: mean wall clock time over the repeats
+* peak_rss_kb:  high water mark of the process resident set size
+  (absolute, includes the interpreter and the input data)
+* rss_kb:       increase of that high water mark during the case
+* objects:      number of (garbage collector tracked) objects created
+  by the case that are still alive at the end of it, result included
+"""
+
+import argparse
+import datetime
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+def git_revision():
+    """
+    The git commit we are sitting on (None if we can't tell)
+    """
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                      stderr=open(os.devnull, 'w'))
+        return out.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _measure_here(action, setup, repeat):
+    """
+    Run the case in this process; see `measure`
+    """
+    arg = setup() if setup is not None else None
+    gc.collect()
+    rss_before     = _max_rss()
+    objects_before = len(gc.get_objects())
+    timings = []
+    result  = None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        start  = time.time()
+        result = action(arg) if setup is not None else action()
+        timings.append(time.time() - start)
+    gc.collect()
+    objects_after = len(gc.get_objects())
+    rss_after     = _max_rss()
+    del result
+    return { 'seconds'      : min(timings)
+           , 'mean_seconds' : sum(timings) / len(timings)
+           , 'peak_rss_kb'  : rss_after
+           , 'rss_kb'       : rss_after - rss_before
+           , 'objects'      : objects_after - objects_before
+           }
+
+def measure(action, setup=None, repeat=3):
+    """
+    Time an action (in a child process), returning a dictionary of
+    measurements (see the module documentation).
+
+    If `setup` is given, its result is passed to the action, and
+    its cost is not counted
+    """
+    conn_parent, conn_child = multiprocessing.Pipe(False)
+    def child():
+        try:
+            conn_child.send(_measure_here(action, setup, repeat))
+        except Exception as e:
+            conn_child.send({'error': '%s: %s' % (type(e).__name__, e)})
+        conn_child.close()
+    proc = multiprocessing.Process(target=child)
+    proc.start()
+    result = conn_parent.recv()
+    proc.join()
+    return result
+
+class Suite:
+    """
+    A named collection of benchmark cases.
+
+    Cases are added with `add` and run (in the order they were added)
+    with `run`, which returns a run record suitable for `save`
+    """
+    def __init__(self, name):
+        self.name  = name
+        self.cases = []
+
+    def add(self, name, action, setup=None, params=None):
+        """
+        Register a case. `params` is a dictionary describing the
+        inputs (eg. document sizes), recorded alongside the results
+        """
+        self.cases.append((name, action, setup, params or {}))
+
+    def run(self, repeat=3, verbose=True):
+        results = []
+        for name, action, setup, params in self.cases:
+            res = measure(action, setup, repeat)
+            if verbose:
+                sys.stderr.write('%s %s\n' % (name, _show(res)))
+            record = { 'case'   : name
+                     , 'params' : params
+                     }
+            record.update(res)
+            results.append(record)
+        return { 'suite'    : self.name
+               , 'revision' : git_revision()
+               , 'date'     : datetime.datetime.now().isoformat()
+               , 'python'   : platform.python_version()
+               , 'repeat'   : repeat
+               , 'results'  : results
+               }
+
+def _show(res):
+    if 'error' in res:
+        return 'ERROR ' + res['error']
+    return '%.4fs (mean %.4fs) rss +%dkB objects %+d' %\
+            (res['seconds'], res['mean_seconds'], res['rss_kb'], res['objects'])
+
+def load(filename):
+    """
+    All run records in a results file (oldest first)
+    """
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+def save(filename, run):
+    """
+    Append a run record to a results file
+    """
+    runs = load(filename)
+    runs.append(run)
+    with open(filename, 'w') as f:
+        json.dump(runs, f, indent=1, sort_keys=True)
+
+def mk_arg_parser(description):
+    """
+    Command line arguments common to all suites
+    """
+    arg_parser = argparse.ArgumentParser(description=description)
+    arg_parser.add_argument('--output', metavar='FILE',
+                            help='Append results to this JSON file')
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='Timing repeats per case (default 3)')
+    arg_parser.add_argument('--sizes', metavar='N,N..',
+                            type=lambda s: [int(x) for x in s.split(',')],
+                            help='Comma-separated list of document sizes (EDUs)')
+    return arg_parser
+
+def run_suite(suite, args):
+    """
+    Run a suite according to command line arguments
+    (see `mk_arg_parser`), saving the results if asked to
+    """
+    run = suite.run(repeat=args.repeat)
+    if args.output:
+        save(args.output, run)
+    return run
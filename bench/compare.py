@@ -0,0 +1,53 @@
+# Author: Eric Kow
+# License: BSD3
+
+"""
+Compare two benchmark runs, case by case ::
+
+    python -m bench.compare results.json            # last two runs
+    python -m bench.compare old.json new.json       # last run of each
+"""
+
+import argparse
+import sys
+
+import bench
+
+METRICS = ['seconds', 'peak_rss_kb', 'objects']
+
+def _index(run):
+    return dict((r['case'], r) for r in run['results'] if 'error' not in r)
+
+def compare(old, new, out=sys.stdout):
+    """
+    Print a table of old vs new measurements for cases in common
+    """
+    old_cases = _index(old)
+    new_cases = _index(new)
+    out.write('# %s (%s) -> %s (%s)\n' % (old.get('revision'), old.get('date'),
+                                          new.get('revision'), new.get('date')))
+    for case in sorted(set(old_cases) & set(new_cases)):
+        cells = []
+        for m in METRICS:
+            before = old_cases[case][m]
+            after  = new_cases[case][m]
+            ratio  = float(after) / before if before else float('nan')
+            cells.append('%s %s -> %s (x%.2f)' % (m, before, after, ratio))
+        out.write('%-20s %s\n' % (case, '; '.join(cells)))
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Compare benchmark runs')
+    arg_parser.add_argument('files', metavar='FILE', nargs='+')
+    args = arg_parser.parse_args()
+    if len(args.files) == 1:
+        runs = bench.load(args.files[0])
+        if len(runs) < 2:
+            sys.exit('Need at least two runs in %s' % args.files[0])
+        old, new = runs[-2], runs[-1]
+    else:
+        old = bench.load(args.files[0])[-1]
+        new = bench.load(args.files[1])[-1]
+    compare(old, new)
+
+if __name__ == '__main__':
+    main()
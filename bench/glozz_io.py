@@ -0,0 +1,61 @@
+# Author: Eric Kow
+# License: BSD3
+
+"""
+Benchmarks for reading and writing Glozz files ::
+
+    python -m bench.glozz_io --sizes 100,1000 --output results.json
+
+For each document size, we measure
+
+* read:   `glozz.read_annotation_file` (aa and ac file)
+* to_xml: `GlozzDocument.to_xml`
+* write:  `glozz.write_annotation_file`
+"""
+
+import os
+import shutil
+import tempfile
+
+from educe import glozz
+import bench
+from bench.synthetic import Parameters, synthetic_document, write_document
+
+DEFAULT_SIZES = [100, 1000, 5000]
+
+def mk_suite(tmpdir, sizes=None):
+    suite = bench.Suite('glozz_io')
+    for size in sizes or DEFAULT_SIZES:
+        params = Parameters(edus=size)
+        doc    = synthetic_document(params)
+        stub   = os.path.join(tmpdir, 'synthetic-%d' % size)
+        aa_path, ac_path = write_document(doc, stub)
+        out_path = stub + '-out.aa'
+        info = params.to_dict()
+        info['bytes'] = os.path.getsize(aa_path)
+
+        def read(aa_path=aa_path, ac_path=ac_path):
+            return glozz.read_annotation_file(aa_path, ac_path)
+
+        def to_xml(doc):
+            return doc.to_xml()
+
+        def write(doc, out_path=out_path):
+            glozz.write_annotation_file(out_path, doc)
+
+        suite.add('read/%d'   % size, read, params=info)
+        suite.add('to_xml/%d' % size, to_xml, setup=read, params=info)
+        suite.add('write/%d'  % size, write,  setup=read, params=info)
+    return suite
+
+def main():
+    arg_parser = bench.mk_arg_parser('Glozz read/write benchmarks')
+    args       = arg_parser.parse_args()
+    tmpdir     = tempfile.mkdtemp()
+    try:
+        bench.run_suite(mk_suite(tmpdir, args.sizes), args)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
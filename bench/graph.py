@@ -0,0 +1,117 @@
+# Author: Eric Kow
+# License: BSD3
+
+"""
+Benchmarks for the discourse graph code ::
+
+    python -m bench.graph --sizes 100,1000 --output results.json
+
+For each document size and each graph backend (`stac.graph.Graph`
+on python-graph, and `stac.graph.IndexedGraph`), we measure
+
+* from_doc:             `Graph.from_doc`
+* copy:                 `Graph.copy` (whole graph)
+* connected_components: `Graph.connected_components`
+* right_frontier:       `Graph.right_frontier_violations`
+
+and, on documents with more (and more deeply nested) CDUs than usual
+
+* dot:                  `educe.graph.DotGraph` (generic)
+* stac_dot:             `educe.stac.graph.DotGraph`
+* right_frontier_cdus:  `Graph.right_frontier_violations`
+* without_cdus:         `Graph.without_cdus`
+"""
+
+from educe import corpus
+import educe.graph
+import educe.stac.graph as stac_gr
+import bench
+from bench.synthetic import Parameters, synthetic_document
+
+DEFAULT_SIZES = [100, 1000, 5000]
+
+BACKENDS = [ ('hypergraph', stac_gr.Graph)
+           , ('indexed',    stac_gr.IndexedGraph)
+           ]
+
+def synthetic_corpus(params, seed=0):
+    """
+    Single document corpus (and its key) built from a synthetic
+    document
+    """
+    key = corpus.FileId('synthetic', 'discourse', 'bench', None)
+    doc = synthetic_document(params, seed)
+    doc.fleshout(key)
+    return {key: doc}, key
+
+def mk_suite(sizes=None):
+    suite = bench.Suite('graph')
+    for size in sizes or DEFAULT_SIZES:
+        params = Parameters(edus=size)
+        for backend, cls in BACKENDS:
+            info = params.to_dict()
+            info['backend'] = backend
+
+            def load(cls=cls, params=params):
+                return synthetic_corpus(params)
+
+            def build(args, cls=cls):
+                corpus_, key = args
+                return cls.from_doc(corpus_, key)
+
+            def build_only(cls=cls, params=params):
+                return build_graph(cls, params)
+
+            def copy(gr):
+                return gr.copy()
+
+            def connected_components(gr):
+                return gr.connected_components()
+
+            def right_frontier(gr):
+                return gr.right_frontier_violations()
+
+            name = '%s/%s/%d' % ('%s', backend, size)
+            suite.add(name % 'from_doc', build, setup=load, params=info)
+            suite.add(name % 'copy', copy,
+                      setup=build_only, params=info)
+            suite.add(name % 'connected_components', connected_components,
+                      setup=build_only, params=info)
+            suite.add(name % 'right_frontier', right_frontier,
+                      setup=build_only, params=info)
+    for size in sizes or DEFAULT_SIZES:
+        params = Parameters(edus=size, schemas=size // 4, depth=4)
+        info   = params.to_dict()
+
+        def build_cdu_heavy(params=params):
+            return build_graph(stac_gr.IndexedGraph, params)
+
+        def dot(gr):
+            return educe.graph.DotGraph(gr)
+
+        def stac_dot(gr):
+            return stac_gr.DotGraph(gr)
+
+        suite.add('dot/%d' % size, dot,
+                  setup=build_cdu_heavy, params=info)
+        suite.add('stac_dot/%d' % size, stac_dot,
+                  setup=build_cdu_heavy, params=info)
+        suite.add('right_frontier_cdus/%d' % size,
+                  lambda gr: gr.right_frontier_violations(),
+                  setup=build_cdu_heavy, params=info)
+        suite.add('without_cdus/%d' % size,
+                  lambda gr: gr.without_cdus(sloppy=True),
+                  setup=build_cdu_heavy, params=info)
+    return suite
+
+def build_graph(cls, params):
+    corpus_, key = synthetic_corpus(params)
+    return cls.from_doc(corpus_, key)
+
+def main():
+    arg_parser = bench.mk_arg_parser('Discourse graph benchmarks')
+    args       = arg_parser.parse_args()
+    bench.run_suite(mk_suite(args.sizes), args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# Author: Eric Kow
+# License: BSD3
+
+"""
+Synthetic Glozz documents for benchmarking
+
+The documents loosely follow STAC conventions so that the project
+layer can be benchmarked on them too: a sequence of turns (`Turn`
+units whose text starts with a "number: speaker: " prefix), each
+containing a few EDUs (`Segment` units), relation instances between
+nearby EDUs (with STAC relation labels), and complex discourse units
+(`Complex_discourse_unit` schemas) which may be nested.
+
+The generator is deterministic for any given seed.
+"""
+
+import cStringIO as StringIO
+import random
+
+from educe import glozz, stac
+from educe.annotation import Span, RelSpan, Unit, Relation, Schema
+
+_WORDS = [ u'wheat', u'sheep', u'ore', u'clay', u'wood', u'anyone',
+           u'trade', u'for', u'give', u'you', u'one', u'two', u'no',
+           u'yes', u'ok', u'sorry', u'réponse', u'ça', u'marche' ]
+
+_SPEAKERS = [ u'Alice', u'Bob', u'Carol', u'Dave' ]
+
+_RELATION_TYPES = stac.subordinating_relations + stac.coordinating_relations
+
+class Parameters:
+    """
+    Shape of a synthetic document
+
+    :param edus: number of EDUs
+    :param relations: number of relation instances
+    :param schemas: number of CDUs (spread over the nesting levels)
+    :param depth: how many levels of CDUs (1: no nesting)
+    :param features: number of features per annotation
+    :param edus_per_turn: how many EDUs to a turn
+    :param window: maximum distance (in EDUs) between related EDUs
+    """
+    def __init__(self, edus=100, relations=None, schemas=None, depth=3,
+                 features=4, edus_per_turn=3, window=5):
+        self.edus          = edus
+        self.relations     = edus if relations is None else relations
+        self.schemas       = edus // 10 if schemas is None else schemas
+        self.depth         = depth
+        self.features      = features
+        self.edus_per_turn = edus_per_turn
+        self.window        = window
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+def synthetic_document(params=None, seed=0):
+    """
+    Return a fresh `GlozzDocument` (with text) shaped according to the
+    given `Parameters`
+    """
+    params  = params or Parameters()
+    rng     = random.Random(seed)
+    counter = [0]
+
+    def mk_metadata():
+        counter[0] += 1
+        return { 'author'               : u'bench'
+               , 'creation-date'        : unicode(counter[0])
+               , 'lastModifier'         : u'n/a'
+               , 'lastModificationDate' : u'0'
+               }, u'bench_%d' % counter[0]
+
+    def mk_features(extra=None):
+        fs = dict((u'Feature%d' % i, rng.choice(_WORDS))
+                  for i in range(params.features))
+        fs.update(extra or {})
+        return fs
+
+    text    = []
+    offset  = [0]
+    def emit(s):
+        text.append(s)
+        start      = offset[0]
+        offset[0] += len(s)
+        return Span(start, offset[0])
+
+    units = []
+    edus  = []
+    nturns = (params.edus + params.edus_per_turn - 1) // params.edus_per_turn
+    for t in range(nturns):
+        speaker    = rng.choice(_SPEAKERS)
+        turn_start = offset[0]
+        emit(u'%d : %s : ' % (t + 1, speaker))
+        for _ in range(min(params.edus_per_turn, params.edus - len(edus))):
+            nwords = rng.randint(2, 8)
+            span   = emit(u' '.join(rng.choice(_WORDS) for _ in range(nwords)))
+            emit(u' ')
+            metadata, anno_id = mk_metadata()
+            edu = Unit(anno_id, span, u'Segment', mk_features(), metadata)
+            edus.append(edu)
+        turn_span  = Span(turn_start, offset[0] - 1)
+        emit(u'\n')
+        metadata, anno_id = mk_metadata()
+        turn_fs = mk_features({ u'Emitter'    : speaker
+                              , u'Identifier' : unicode(t + 1)
+                              })
+        units.append(Unit(anno_id, turn_span, u'Turn', turn_fs, metadata))
+    units.extend(edus)
+
+    relations = []
+    if len(edus) > 1:
+        for _ in range(params.relations):
+            i = rng.randrange(0, len(edus) - 1)
+            j = min(len(edus) - 1, i + rng.randint(1, params.window))
+            metadata, anno_id = mk_metadata()
+            span = RelSpan(edus[i].local_id(), edus[j].local_id())
+            relations.append(Relation(anno_id, span,
+                                      rng.choice(_RELATION_TYPES),
+                                      mk_features(), metadata))
+
+    # CDUs: the first level groups a few consecutive EDUs, the next
+    # levels group a few consecutive CDUs from the level below
+    schemas  = []
+    below    = [ (e, 'unit') for e in edus ]
+    levels   = max(1, params.depth)
+    quota    = [ params.schemas // levels ] * levels
+    quota[0] += params.schemas - sum(quota)
+    for level in range(levels):
+        current = []
+        pos     = 0
+        for _ in range(quota[level]):
+            if pos >= len(below):
+                pos = 0
+            width   = rng.randint(2, 3)
+            members = below[pos:pos + width]
+            pos    += width + rng.randint(0, 2)
+            units_  = frozenset(m.local_id() for m, k in members if k == 'unit')
+            schemas_ = frozenset(m.local_id() for m, k in members if k == 'schema')
+            metadata, anno_id = mk_metadata()
+            cdu = Schema(anno_id, units_, frozenset(), schemas_,
+                         u'Complex_discourse_unit', mk_features(), metadata)
+            schemas.append(cdu)
+            current.append((cdu, 'schema'))
+        if not current:
+            break
+        below = current
+
+    return glozz.GlozzDocument(None, units, relations, schemas, u''.join(text))
+
+def write_document(doc, path_stub):
+    """
+    Save a synthetic document as a Glozz aa/ac pair, returning
+    their paths
+    """
+    ac_path    = path_stub + '.ac'
+    aa_path    = path_stub + '.aa'
+    text_bytes = doc.text().encode('utf-8')
+    with open(ac_path, 'wb') as f:
+        f.write(text_bytes)
+    doc.hashcode = glozz.hashcode(StringIO.StringIO(text_bytes))
+    glozz.write_annotation_file(aa_path, doc)
+    return aa_path, ac_path
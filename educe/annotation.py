@@ -416,7 +416,9 @@ class Document(Standoff):
         if self._text is None:
             return None
         elif span is None:
-            return self._text
+            # slicing (rather than returning the text as is) so that lazy
+            # text objects like `educe.glozz.MappedText` give us a string
+            return self._text[:]
         else:
             return self._text[span.char_start:span.char_end]
 
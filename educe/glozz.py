@@ -10,9 +10,20 @@ You're likely most interested in
 .. _Glozz: http://www.glozz.org/
 """
 
+import bisect
 import codecs
+import collections
+import errno
+import io
+import mmap
+import multiprocessing
+import os
+import stat
+import tempfile
+import time
 import xml.etree.ElementTree as ET
 import sys
+from xml.parsers import expat
 
 from educe.annotation import *
 from educe.internalutil import on_single_element, linebreak_xml
@@ -219,15 +230,301 @@ def read_node(node, context=None):
         return Unit(unit_id, span, unit_type, fs, metadata=metadata)
 
 
-def read_annotation_file(anno_filename, text_filename=None):
+# bytes that can only occur in the middle of a UTF-8 encoded character
+_UTF8_CONTINUATION_BYTES = ''.join(chr(b) for b in range(0x80, 0xC0))
+
+class MappedText(object):
+    """
+    Read-only, lazily decoded view of a UTF-8 text file
+    (eg. a Glozz `.ac` file).
+
+    The file is not read up front, and only the portions you slice out
+    are read and decoded, so that you can work with spans of huge
+    documents without holding all their text in memory. Slicing works
+    in terms of character offsets, just like a unicode string would:
+    `text[3:10]`
+
+    To make this possible, we index the file once (memory-mapping it,
+    without decoding it) recording how many characters precede every
+    `block_size` bytes or so. Slicing a span reads and decodes at most
+    the blocks that it touches.
+
+    We do not keep the file (or the mapping) open between slices, so
+    you can have as many of these as you like, and copy or pickle
+    them. The file should still be there, and unchanged, when you
+    slice them
+    """
+    def __init__(self, filename, block_size=65536):
+        self._filename     = filename
+        self._char_offsets = [0]
+        self._byte_offsets = [0]
+        chars = 0
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)\
+                    if size > 0 else ''
+            pos  = 0
+            while pos < size:
+                end = min(pos + block_size, size)
+                # block boundaries should not split a character
+                while end < size and data[end] in _UTF8_CONTINUATION_BYTES:
+                    end += 1
+                block  = data[pos:end]
+                # every character has exactly one non-continuation byte
+                chars += len(block.translate(None, _UTF8_CONTINUATION_BYTES))
+                pos    = end
+                self._char_offsets.append(chars)
+                self._byte_offsets.append(pos)
+            if size > 0:
+                data.close()
+        self._len = chars
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            idx = key + self._len if key < 0 else key
+            if not 0 <= idx < self._len:
+                raise IndexError('MappedText index out of range')
+            return self[idx:idx+1]
+        start, stop, step = key.indices(self._len)
+        if step != 1:
+            return self[start:stop][::step]
+        if start >= stop:
+            return u''
+        # blocks covering [start, stop)
+        i = bisect.bisect_right(self._char_offsets, start) - 1
+        j = bisect.bisect_left(self._char_offsets, stop)
+        with open(self._filename, 'rb') as f:
+            f.seek(self._byte_offsets[i])
+            chunk = f.read(self._byte_offsets[j] - self._byte_offsets[i])
+        offset = self._char_offsets[i]
+        return chunk.decode('utf-8')[start - offset:stop - offset]
+
+    def __unicode__(self):
+        return self[:]
+
+    def close(self):
+        """
+        Nothing to release (we do not keep the file open); this is
+        just here so that you can treat this like a file
+        """
+        pass
+
+# ---------------------------------------------------------------------
+# validation
+# ---------------------------------------------------------------------
+
+class GlozzProblem:
+    """
+    Something wrong with a Glozz annotation file, and where
+    (line numbers start from 1)
+    """
+    def __init__(self, filename, line, message):
+        self.filename = filename
+        self.line     = line
+        self.message  = message
+
+    def __str__(self):
+        return '%s:%s: %s' % (self.filename, self.line, self.message)
+
+class GlozzValidationException(GlozzException):
+    """
+    A Glozz file has one or more problems (see `GlozzProblem`)
+    """
+    def __init__(self, problems):
+        self.problems = problems
+        GlozzException.__init__(self, '\n'.join(str(p) for p in problems))
+
+def _parse_with_lines(anno_filename):
+    """
+    Parse an XML file, returning the root element and a dictionary
+    from elements to the line they start on
+    """
+    builder = ET.TreeBuilder()
+    parser  = expat.ParserCreate()
+    lines   = {}
+    def start_element(tag, attrs):
+        lines[builder.start(tag, attrs)] = parser.CurrentLineNumber
+    parser.StartElementHandler  = start_element
+    parser.EndElementHandler    = builder.end
+    parser.CharacterDataHandler = builder.data
+    with open(anno_filename, 'rb') as f:
+        parser.ParseFile(f)
+    return builder.close(), lines
+
+_ANNOTATION_TAGS = [ 'unit', 'relation', 'schema' ]
+
+_EMBEDDED_TAGS = { 'embedded-unit'     : 'unit'
+                 , 'embedded-relation' : 'relation'
+                 , 'embedded-schema'   : 'schema'
+                 }
+
+def _check_tree(anno_filename, root, lines):
+    """
+    Return a list of problems with a parsed Glozz annotation file
+    """
+    problems = []
+    def problem(elm, msg, *args):
+        problems.append(GlozzProblem(anno_filename, lines.get(elm), msg % args))
+
+    def check_single(parent, tag, optional=False):
+        """
+        Return the only child with this tag (None and complain otherwise)
+        """
+        found = parent.findall(tag)
+        if len(found) == 1:
+            return found[0]
+        elif len(found) > 1:
+            problem(found[1], 'more than one <%s> in <%s>', tag, parent.tag)
+        elif not optional:
+            problem(parent, 'missing <%s> in <%s>', tag, parent.tag)
+        return None
+
+    def check_characterisation(elm):
+        char_elm = check_single(elm, 'characterisation')
+        if char_elm is None:
+            return
+        type_elm = check_single(char_elm, 'type')
+        if type_elm is not None and not (type_elm.text or '').strip():
+            problem(type_elm, 'empty <type>')
+        fs_elm   = check_single(char_elm, 'featureSet', optional=True)
+        if fs_elm is None:
+            return
+        feature_lines = {}
+        for f_elm in fs_elm.findall('feature'):
+            name = f_elm.get('name')
+            if name is None:
+                problem(f_elm, 'feature without a name')
+            elif name in feature_lines:
+                problem(f_elm, 'duplicate feature %s (also on line %s)',
+                        name, feature_lines[name])
+            else:
+                feature_lines[name] = lines.get(f_elm)
+
+    def check_position(elm):
+        pos_elm = check_single(elm, 'singlePosition')
+        if pos_elm is None:
+            return None
+        try:
+            return int(pos_elm.get('index'))
+        except (TypeError, ValueError):
+            problem(pos_elm, 'bad position index %s', pos_elm.get('index'))
+            return None
+
+    ids        = {} # id -> (tag, elm)
+    references = [] # (elm, referenced id, expected tag or None)
+    for elm in root:
+        if elm.tag == 'metadata':
+            if elm.get('corpusHashcode') is None:
+                problem(elm, 'top-level <metadata> without corpusHashcode')
+            continue
+        elif elm.tag not in _ANNOTATION_TAGS:
+            problem(elm, 'unrecognised element <%s>', elm.tag)
+            continue
+
+        anno_id = elm.get('id')
+        if anno_id is None:
+            problem(elm, '<%s> without an id', elm.tag)
+        elif anno_id in ids:
+            problem(elm, 'duplicate id %s (also on line %s)',
+                    anno_id, lines.get(ids[anno_id][1]))
+        else:
+            ids[anno_id] = (elm.tag, elm)
+
+        check_characterisation(elm)
+        check_single(elm, 'metadata', optional=True)
+        pos_elm = check_single(elm, 'positioning')
+        if pos_elm is None:
+            continue
+        if elm.tag == 'unit':
+            start_elm = check_single(pos_elm, 'start')
+            end_elm   = check_single(pos_elm, 'end')
+            start = check_position(start_elm) if start_elm is not None else None
+            end   = check_position(end_elm)   if end_elm   is not None else None
+            if start is not None and end is not None and start > end:
+                problem(pos_elm, 'unit starts (%d) after it ends (%d)', start, end)
+        elif elm.tag == 'relation':
+            terms = pos_elm.findall('term')
+            if len(terms) != 2:
+                problem(pos_elm, 'expected exactly 2 terms, but got %d', len(terms))
+            for t_elm in terms:
+                references.append((t_elm, t_elm.get('id'), None))
+        elif elm.tag == 'schema':
+            for m_elm in pos_elm:
+                if m_elm.tag in _EMBEDDED_TAGS:
+                    references.append((m_elm, m_elm.get('id'), _EMBEDDED_TAGS[m_elm.tag]))
+                else:
+                    problem(m_elm, 'unrecognised schema member <%s>', m_elm.tag)
+
+    for elm, ref_id, expected in references:
+        if ref_id is None:
+            problem(elm, '<%s> without an id', elm.tag)
+        elif ref_id not in ids:
+            problem(elm, 'dangling reference to %s', ref_id)
+        elif expected is not None and ids[ref_id][0] != expected:
+            problem(elm, '<%s> refers to %s, which is a %s',
+                    elm.tag, ref_id, ids[ref_id][0])
+
+    return problems
+
+def _read_validated(anno_filename):
+    """
+    Parse a Glozz annotation file, collecting any problems
+    along the way.
+
+    Return the root element (None if the XML is malformed)
+    and the problems
+    """
+    try:
+        root, lines = _parse_with_lines(anno_filename)
+    except expat.ExpatError as e:
+        return None, [GlozzProblem(anno_filename, e.lineno,
+                                   'malformed XML: %s' % expat.ErrorString(e.code))]
+    if root.tag != 'annotations':
+        return root, [GlozzProblem(anno_filename, lines.get(root),
+                                   'root element is <%s>, not <annotations>' % root.tag)]
+    return root, _check_tree(anno_filename, root, lines)
+
+def validate_annotation_file(anno_filename):
+    """
+    Check a Glozz annotation file for structural problems (malformed
+    positioning, dangling references, duplicate ids, etc), returning
+    a (hopefully empty) list of `GlozzProblem`.
+
+    This reports all of the problems it finds along with their line
+    numbers (rather than stopping at the first one), so it's useful
+    for checking the health of a whole corpus
+    """
+    return _read_validated(anno_filename)[1]
+
+def read_annotation_file(anno_filename, text_filename=None, mmap_text=False,
+                         validate=False):
     """
     Read a single glozz annotation file and its corresponding text
     (if any).
+
+    If `mmap_text` is True, the text is not read up front, but
+    indexed and read/decoded on demand (see `MappedText`); this is
+    helpful if you are only going to look at small pieces of the text
+    of very large documents
+
+    If `validate` is True, the file is checked as it is read (see
+    `validate_annotation_file`), and if there is anything wrong with
+    it, we raise a `GlozzValidationException` listing all the problems
     """
-    tree = ET.parse(anno_filename)
-    (hashcode, units, rels, schemas) = read_node(tree.getroot())
+    if validate:
+        root, problems = _read_validated(anno_filename)
+        if problems:
+            raise GlozzValidationException(problems)
+    else:
+        root = ET.parse(anno_filename).getroot()
+    (hashcode, units, rels, schemas) = read_node(root)
     text = None
-    if text_filename is not None:
+    if text_filename is not None and mmap_text:
+        text = MappedText(text_filename)
+    elif text_filename is not None:
         with codecs.open(text_filename, 'r', 'utf-8') as tf:
             text = tf.read()
     return GlozzDocument(hashcode, units, rels, schemas, text)
@@ -250,11 +547,311 @@ def hashcode(f):
         byte = f.read(1)
     return str(length) + '-' + str(code)
 
+def _annotation_file_bytes(doc, settings=default_output_settings):
+    """
+    The contents of the Glozz XML file we would write for this document
+    """
+    elem = doc.to_xml(settings=settings)
+    linebreak_xml(elem) # ugh, imperative
+    buf  = io.BytesIO()
+    ET.ElementTree(elem).write(buf, encoding='utf-8', xml_declaration=True)
+    return buf.getvalue()
+
 def write_annotation_file(anno_filename, doc, settings=default_output_settings):
     """
     Write a GlozzDocument to XML in the given path
     """
+    with open(anno_filename, 'wb') as f:
+        f.write(_annotation_file_bytes(doc, settings))
 
-    elem = doc.to_xml(settings=settings)
-    linebreak_xml(elem) # ugh, imperative
-    ET.ElementTree(elem).write(anno_filename, encoding='utf-8', xml_declaration=True)
+# ---------------------------------------------------------------------
+# writing many glozz files
+# ---------------------------------------------------------------------
+
+class BulkWriteReport:
+    """
+    What happened during a `write_annotation_files` run
+
+    * written: files that were (re)written
+    * skipped: files left alone because their contents would not change
+    * nbytes:  number of bytes written out
+    * elapsed: wall clock time (seconds)
+    """
+    def __init__(self, written, skipped, nbytes, elapsed):
+        self.written = written
+        self.skipped = skipped
+        self.nbytes  = nbytes
+        self.elapsed = elapsed
+
+    def docs_per_second(self):
+        """
+        Throughput in documents (written or skipped) per second
+        """
+        ndocs = len(self.written) + len(self.skipped)
+        return ndocs / self.elapsed if self.elapsed > 0 else float('inf')
+
+    def __str__(self):
+        return '%d written, %d unchanged, %d bytes in %.2fs (%.1f docs/s)' %\
+                (len(self.written), len(self.skipped), self.nbytes,
+                 self.elapsed, self.docs_per_second())
+
+def _file_mode(filename):
+    """
+    Permission bits for (re)writing a file: those of the existing
+    file if there is one, otherwise what `open` would give a new
+    file under the current umask
+    """
+    try:
+        return stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0666 & ~umask
+
+def _write_if_changed(filename, content):
+    """
+    Replace the file with the given content unless it already has
+    exactly that content. The file is replaced atomically (write to a
+    temporary file in the same directory, and rename over the original),
+    so readers never see a half-written file.
+
+    Return True if the file was written
+    """
+    if os.path.exists(filename) and os.path.getsize(filename) == len(content):
+        with open(filename, 'rb') as f:
+            if f.read() == content:
+                return False
+    dirname = os.path.dirname(filename) or os.curdir
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    fd, tmp_filename = tempfile.mkstemp(dir=dirname,
+                                        prefix='.' + os.path.basename(filename),
+                                        suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        # mkstemp files are private (0600); give ours the permissions
+        # of the file we are replacing, or of a freshly created one
+        os.chmod(tmp_filename, _file_mode(filename))
+        os.rename(tmp_filename, filename)
+    except:
+        os.remove(tmp_filename)
+        raise
+    return True
+
+_bulk_write_items = None
+
+def _init_bulk_writer(items):
+    global _bulk_write_items
+    _bulk_write_items = items
+
+def _bulk_write(i):
+    filename, doc, settings = _bulk_write_items[i]
+    content = _annotation_file_bytes(doc, settings)
+    return filename, _write_if_changed(filename, content), len(content)
+
+def write_annotation_files(docs, settings=default_output_settings, jobs=1):
+    """
+    Write out many GlozzDocuments, possibly in parallel.
+
+    Documents whose XML would be identical to what is already on disk
+    are skipped (and their modification times left untouched); the
+    others are replaced atomically. Return a `BulkWriteReport`
+
+    :param docs: output path to document
+    :type  docs: dict from string to `GlozzDocument`
+
+    :param jobs: number of worker processes to serialise documents in
+    :type  jobs: int
+    """
+    start = time.time()
+    items = [ (f, docs[f], settings) for f in sorted(docs) ]
+    if jobs > 1 and len(items) > 1:
+        # the workers inherit the documents from us (no need to pickle
+        # them all) and just tell us what they did with them
+        pool = multiprocessing.Pool(jobs,
+                                    initializer=_init_bulk_writer,
+                                    initargs=(items,))
+        try:
+            results = pool.map(_bulk_write, range(len(items)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_bulk_writer(items)
+        results = map(_bulk_write, range(len(items)))
+        _init_bulk_writer(None)
+
+    written = [ f for f, changed, _ in results if changed ]
+    skipped = [ f for f, changed, _ in results if not changed ]
+    nbytes  = sum(n for _, changed, n in results if changed)
+    return BulkWriteReport(written, skipped, nbytes, time.time() - start)
+
+# ---------------------------------------------------------------------
+# patching glozz files
+# ---------------------------------------------------------------------
+
+_GLOZZ_TAG_ORDER = ['metadata', 'unit', 'relation', 'schema']
+
+def _glozz_tag(anno):
+    """
+    The Glozz XML tag we would use to write out the annotation
+    """
+    if isinstance(anno, Unit):
+        return 'unit'
+    elif isinstance(anno, Relation):
+        return 'relation'
+    elif isinstance(anno, Schema):
+        return 'schema'
+    else:
+        raise GlozzException("Don't know how to emit XML for %s" % anno)
+
+def _top_level_extents(data):
+    """
+    Return the offset just past the root element's opening tag in a
+    Glozz XML bytestring, along with its children, as a list of
+    `(tag, id, start, end)` tuples where `start` and `end` are byte
+    offsets.
+
+    We use expat directly here (rather than ElementTree) because we
+    are only interested in where things are, not what they contain
+    """
+    parser  = expat.ParserCreate()
+    extents = []
+    state   = { 'depth'   : 0
+              , 'current' : None
+              , 'content' : False
+              , 'root'    : None
+              }
+
+    def start_element(tag, attrs):
+        state['depth'] += 1
+        if state['depth'] == 1:
+            state['root'] = data.index('>', parser.CurrentByteIndex) + 1
+        elif state['depth'] == 2:
+            state['current'] = (tag, attrs.get('id'), parser.CurrentByteIndex)
+            state['content'] = False
+        elif state['depth'] > 2:
+            state['content'] = True
+
+    def char_data(_):
+        if state['depth'] >= 2:
+            state['content'] = True
+
+    def end_element(tag):
+        idx = parser.CurrentByteIndex
+        if state['depth'] == 2:
+            tag, anno_id, start = state['current']
+            # expat reports empty elements (<foo/>) as ending just past
+            # the '/>'; otherwise we are looking at the closing tag
+            if not state['content'] and data[idx-2:idx] == '/>':
+                end = idx
+            else:
+                end = data.index('>', idx) + 1
+            extents.append((tag, anno_id, start, end))
+        elif state['depth'] == 1 and data[idx:idx+2] != '</':
+            raise GlozzException("Glozz annotation file has an empty root element")
+        state['depth'] -= 1
+
+    parser.StartElementHandler  = start_element
+    parser.EndElementHandler    = end_element
+    parser.CharacterDataHandler = char_data
+    parser.Parse(data, True)
+    return state['root'], extents
+
+def _annotation_bytes(anno, tag, settings, newline):
+    """
+    Serialise a single annotation as a Glozz XML fragment
+    """
+    elm = glozz_annotation_to_xml(anno, tag, settings)
+    linebreak_xml(elm)
+    elm.tail = None
+    return ET.tostring(elm, encoding='utf-8').replace('\n', newline)
+
+def patch_annotation_file(anno_filename, output_filename=None,
+                          additions=None, deletions=None, feature_edits=None,
+                          settings=default_output_settings):
+    """
+    Apply a handful of changes to an existing Glozz annotation file
+    without rebuilding the whole document.
+
+    The file is streamed through, and only the affected elements are
+    touched; everything else (including formatting, and any oddities
+    in the original XML) is copied through byte-for-byte. This is
+    meant for automatic annotators that add or tweak a few annotations
+    in a large file
+
+    :param additions: new annotations; they are inserted after the last
+        existing element of the same kind (units, relations, schemas)
+    :type  additions: iterable of `Unit`, `Relation` or `Schema`
+
+    :param deletions: local ids of annotations to remove
+    :type  deletions: iterable of strings
+
+    :param feature_edits: local id to a dictionary of feature names to
+        values; a value of `None` removes the feature
+    :type  feature_edits: dict from string to dict
+
+    :param output_filename: where to write the results (default: the
+        input file)
+    """
+    additions     = list(additions or [])
+    deletions     = frozenset(deletions or [])
+    feature_edits = feature_edits or {}
+    if output_filename is None:
+        output_filename = anno_filename
+
+    with open(anno_filename, 'rb') as f:
+        data = f.read()
+    newline = '\r\n' if '\r\n' in data else '\n'
+    root, extents = _top_level_extents(data)
+
+    seen_ids = set(x[1] for x in extents if x[1] is not None)
+    for anno_id in deletions | frozenset(feature_edits):
+        if anno_id not in seen_ids:
+            raise GlozzException("No annotation with id %s in %s" % (anno_id, anno_filename))
+    for anno in additions:
+        if anno.local_id() in seen_ids - deletions:
+            raise GlozzException("Annotation id %s already in %s" % (anno.local_id(), anno_filename))
+
+    # where to insert new elements of each kind: just after the last element
+    # whose kind sorts no later than it (see `GlozzDocument.to_xml`)
+    def rank(tag):
+        return _GLOZZ_TAG_ORDER.index(tag) if tag in _GLOZZ_TAG_ORDER else 0
+    inserts = collections.defaultdict(list)
+    for anno in additions:
+        tag    = _glozz_tag(anno)
+        before = [ i for i, x in enumerate(extents) if rank(x[0]) <= rank(tag) ]
+        pos    = before[-1] if before else -1
+        inserts[pos].append(newline + _annotation_bytes(anno, tag, settings, newline))
+
+    chunks = []
+    prev   = root
+    chunks.append(data[:prev])
+    chunks.extend(inserts[-1])
+    for i, (tag, anno_id, start, end) in enumerate(extents):
+        gap = data[prev:start]
+        if anno_id in deletions:
+            pass
+        elif anno_id in feature_edits:
+            anno = read_node(ET.fromstring(data[start:end]))
+            for k, v in feature_edits[anno_id].items():
+                if v is None:
+                    anno.features.pop(k, None)
+                else:
+                    anno.features[k] = v
+            chunks.append(gap)
+            chunks.append(_annotation_bytes(anno, tag, settings, newline))
+        else:
+            chunks.append(data[prev:end])
+        chunks.extend(inserts[i])
+        prev = end
+    chunks.append(data[prev:])
+
+    with open(output_filename, 'wb') as f:
+        f.write(''.join(chunks))
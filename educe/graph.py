@@ -10,6 +10,12 @@ Classes of interest:
 * Graph: the core structure, use the `Graph.from_doc` factory
   method to build one out of an `educe.annotation` document.
 
+* IndexedGraph: same thing, but on a faster (pure Python) storage
+  backend than the one python-graph provides
+
+* GraphCache: saves graphs to disk, so that they need not be
+  rebuilt every time a script runs
+
 * DotGraph: visual representation, built from `Graph`.
   You probably want a project-specific variant to get more
   helpful graphs, see eg. `educe.stac.Graph.DotGraph`
@@ -96,15 +102,20 @@ Classes
 
 import copy
 import collections
+import cPickle as pickle
+import hashlib
+import multiprocessing
+import os
+import tempfile
 import textwrap
 
-from educe import corpus
+from educe import annotation, corpus
 from pygraph.readwrite import dot
 import pydot
 import pygraph.classes.hypergraph as gr
 import pygraph.classes.digraph    as dgr
+from pygraph.classes.exceptions import AdditionError
 from pygraph.algorithms import traversal
-from pygraph.algorithms import accessibility
 
 class DuplicateIdException(Exception):
     def __init__(self, duplicate):
@@ -125,6 +136,48 @@ class AttrsMixin():
     def edge_attributes_dict(self, x):
         return dict(self.edge_attributes(x))
 
+    def _node_attrs_view(self, x):
+        """
+        Attributes of a node as a dictionary, which the caller
+        promises not to modify (backends that already store
+        their attributes as a dictionary can just return that)
+        """
+        return self.node_attributes_dict(x)
+
+    def _edge_attrs_view(self, x):
+        """
+        See `_node_attrs_view`
+        """
+        return self.edge_attributes_dict(x)
+
+    def _clear_node_attributes(self, x):
+        """
+        Remove all the attributes of a node (python-graph has no way
+        to replace an attribute; it just piles them up)
+        """
+        self.node_attr[x] = []
+
+    def _node_edges(self, node):
+        """
+        Hyperedges linked to a node. This is `links` seen from the
+        node side only, which matters if a node and an edge share
+        the same name
+        """
+        return self.node_links[node]
+
+    def _candidate_nodes(self, type):
+        """
+        Nodes that may be of the given type (a superset: backends
+        which keep track of types can narrow this down)
+        """
+        return self.nodes()
+
+    def _candidate_edges(self, type):
+        """
+        Hyperedges that may be of the given type (see `_candidate_nodes`)
+        """
+        return self.hyperedges()
+
     def _attrs(self, x):
         """
         (abstract) should be implemented
@@ -192,6 +245,218 @@ class AttrsMixin():
         else:
             return self.mirror(x)
 
+class IndexedHypergraph(gr.hypergraph):
+    """
+    Alternative storage for python-graph's `hypergraph`, offering the same
+    API (so it can be mixed into `Graph` as a backend, see `IndexedGraph`)
+    but organised for speed rather than generality:
+
+        * nodes and hyperedges are internally numbered, and their links
+          are stored as lists of numbers in both directions
+        * attributes are kept in a dictionary per node/edge, so looking
+          one up does not involve rebuilding anything
+        * nodes and edges are indexed by their 'type' attribute
+
+    Attributes behave like a dictionary: adding an attribute with a key
+    that is already present replaces the older value (which is also
+    what you get when you call `dict` on the attribute list of the
+    python-graph version)
+    """
+    def __init__(self):
+        # we deliberately do not call the hypergraph constructor;
+        # none of its storage is used here
+        self._node_ids    = {} # node name -> number
+        self._edge_ids    = {} # edge name -> number
+        self._node_names  = [] # number -> node name (None if deleted)
+        self._edge_names  = [] # number -> edge name (None if deleted)
+        self._node_links  = [] # number -> list of edge numbers
+        self._edge_links  = [] # number -> list of node numbers
+        self._node_attrs  = [] # number -> attribute dict
+        self._edge_attrs  = [] # number -> attribute dict
+        self._typed_nodes = collections.defaultdict(set)
+        self._typed_edges = collections.defaultdict(set)
+        self.edge_properties = {} # weights/labels (python-graph)
+
+    def __iter__(self):
+        return iter(self._node_ids)
+
+    def __len__(self):
+        return len(self._node_ids)
+
+    def order(self):
+        return len(self._node_ids)
+
+    def __getitem__(self, node):
+        return iter(self.neighbors(node))
+
+    # --------------------------------------------------
+    # nodes and edges
+    # --------------------------------------------------
+
+    def nodes(self):
+        return list(self._node_ids)
+
+    def hyperedges(self):
+        return list(self._edge_ids)
+
+    def edges(self):
+        return self.hyperedges()
+
+    def has_node(self, node):
+        return node in self._node_ids
+
+    def has_edge(self, hyperedge):
+        return hyperedge in self._edge_ids
+
+    def has_hyperedge(self, hyperedge):
+        return hyperedge in self._edge_ids
+
+    def add_node(self, node):
+        if node in self._node_ids:
+            raise AdditionError("Node %s already in graph" % node)
+        self._node_ids[node] = len(self._node_names)
+        self._node_names.append(node)
+        self._node_links.append([])
+        self._node_attrs.append({})
+
+    def del_node(self, node):
+        i = self._node_ids.pop(node, None)
+        if i is None:
+            return
+        for j in self._node_links[i]:
+            self._edge_links[j].remove(i)
+        self._typed_nodes[self._node_attrs[i].get('type')].discard(node)
+        self._node_names[i] = None
+        self._node_links[i] = None
+        self._node_attrs[i] = None
+
+    def add_edge(self, hyperedge):
+        self.add_hyperedge(hyperedge)
+
+    def add_hyperedge(self, hyperedge):
+        if hyperedge in self._edge_ids:
+            return
+        self._edge_ids[hyperedge] = len(self._edge_names)
+        self._edge_names.append(hyperedge)
+        self._edge_links.append([])
+        self._edge_attrs.append({})
+
+    def del_edge(self, hyperedge):
+        self.del_hyperedge(hyperedge)
+
+    def del_hyperedge(self, hyperedge):
+        j = self._edge_ids.pop(hyperedge, None)
+        if j is None:
+            return
+        for i in self._edge_links[j]:
+            self._node_links[i].remove(j)
+        self._typed_edges[self._edge_attrs[j].get('type')].discard(hyperedge)
+        self.edge_properties.pop(hyperedge, None)
+        self._edge_names[j] = None
+        self._edge_links[j] = None
+        self._edge_attrs[j] = None
+
+    # --------------------------------------------------
+    # links
+    # --------------------------------------------------
+
+    def link(self, node, hyperedge):
+        i = self._node_ids[node]
+        j = self._edge_ids[hyperedge]
+        if j in self._node_links[i]:
+            raise AdditionError("Link (%s, %s) already in graph" %\
+                                (node, hyperedge))
+        self._edge_links[j].append(i)
+        self._node_links[i].append(j)
+
+    def unlink(self, node, hyperedge):
+        i = self._node_ids[node]
+        j = self._edge_ids[hyperedge]
+        self._node_links[i].remove(j)
+        self._edge_links[j].remove(i)
+
+    def links(self, obj):
+        """
+        Nodes linked by a hyperedge, or hyperedges linked to a node
+        (hyperedges take priority if the name is used for both).
+
+        Unlike python-graph, this returns a fresh list each time
+        """
+        j = self._edge_ids.get(obj)
+        if j is not None:
+            names = self._node_names
+            return [names[i] for i in self._edge_links[j]]
+        else:
+            names = self._edge_names
+            return [names[j] for j in self._node_links[self._node_ids[obj]]]
+
+    def _node_edges(self, node):
+        names = self._edge_names
+        return [names[j] for j in self._node_links[self._node_ids[node]]]
+
+    def neighbors(self, obj):
+        i         = self._node_ids[obj]
+        neighbors = set()
+        for j in self._node_links[i]:
+            neighbors.update(self._edge_links[j])
+        neighbors.discard(i)
+        names = self._node_names
+        return [names[n] for n in neighbors]
+
+    def rank(self):
+        return max([len(self._edge_links[j])
+                    for j in self._edge_ids.values()] or [0])
+
+    # --------------------------------------------------
+    # attributes
+    # --------------------------------------------------
+
+    def add_node_attribute(self, node, attr):
+        attrs = self._node_attrs[self._node_ids[node]]
+        self._retype(self._typed_nodes, node, attrs, attr)
+        attrs[attr[0]] = attr[1]
+
+    def add_edge_attribute(self, edge, attr):
+        attrs = self._edge_attrs[self._edge_ids[edge]]
+        self._retype(self._typed_edges, edge, attrs, attr)
+        attrs[attr[0]] = attr[1]
+
+    def node_attributes(self, node):
+        return self._node_attrs[self._node_ids[node]].items()
+
+    def edge_attributes(self, edge):
+        j = self._edge_ids.get(edge)
+        return [] if j is None else self._edge_attrs[j].items()
+
+    def node_attributes_dict(self, x):
+        return dict(self._node_attrs[self._node_ids[x]])
+
+    def edge_attributes_dict(self, x):
+        j = self._edge_ids.get(x)
+        return {} if j is None else dict(self._edge_attrs[j])
+
+    def _node_attrs_view(self, x):
+        return self._node_attrs[self._node_ids[x]]
+
+    def _edge_attrs_view(self, x):
+        return self._edge_attrs[self._edge_ids[x]]
+
+    def _candidate_nodes(self, type):
+        return list(self._typed_nodes.get(type, ()))
+
+    def _candidate_edges(self, type):
+        return list(self._typed_edges.get(type, ()))
+
+    def _clear_node_attributes(self, x):
+        attrs = self._node_attrs[self._node_ids[x]]
+        self._typed_nodes[attrs.get('type')].discard(x)
+        attrs.clear()
+
+    def _retype(self, index, x, attrs, attr):
+        if attr[0] == 'type':
+            index[attrs.get('type')].discard(x)
+            index[attr[1]].add(x)
+
 class Graph(gr.hypergraph, AttrsMixin):
     """
     Hypergraph representation of discourse structure.
@@ -224,7 +489,10 @@ class Graph(gr.hypergraph, AttrsMixin):
 
     def __init__(self):
         AttrsMixin.__init__(self)
-        gr.hypergraph.__init__(self)
+        # not gr.hypergraph directly, so that an alternative
+        # backend can slot itself in (see `IndexedGraph`)
+        super(Graph, self).__init__()
+        self._invalidate_indexes()
 
     @classmethod
     def from_doc(cls, corpus, doc_key, pred=lambda x:True):
@@ -250,19 +518,21 @@ class Graph(gr.hypergraph, AttrsMixin):
         self.doc_key = doc_key
         self.doc     = doc
 
+        rels  = [ x for x in doc.relations if pred(x) ]
+        cdus  = [ s for s in doc.schemas   if pred(s) ]
+
         # objects that are pointed to by a relations or schemas
-        pointed_to = []
-        for x in filter(pred, doc.relations):
-            pointed_to.extend([x.span.t1, x.span.t2])
-        for x in filter(pred, doc.schemas):
-            pointed_to.extend(x.span)
+        pointed_to = set()
+        for x in rels:
+            pointed_to.add(x.span.t1)
+            pointed_to.add(x.span.t2)
+        for x in cdus:
+            pointed_to.update(x.span)
 
         nodes = []
         edges = []
 
         edus  = [ x for x in doc.units   if x.local_id() in pointed_to and pred(x) ]
-        rels  = filter(pred, doc.relations)
-        cdus  = [ s for s in doc.schemas if pred(s) ]
 
         for x in edus: nodes.append(self._unit_node(x))
         for x in rels: nodes.append(self._rel_node(x))
@@ -286,6 +556,223 @@ class Graph(gr.hypergraph, AttrsMixin):
 
         return self
 
+    @classmethod
+    def from_corpus(cls, corpus, keys=None, jobs=1):
+        """
+        Return a dictionary from document keys to graph representations
+        of those documents (see `from_doc`), possibly building them in
+        parallel.
+
+        The graphs refer to the annotation objects in the corpus you
+        pass in, just as if you had called `from_doc` on each key
+        yourself (worker processes only send back the graph structure,
+        which we then reattach to our copy of the annotations)
+
+        :param keys: documents to build graphs for (default: all)
+        :type  keys: iterable of `FileId`
+
+        :param jobs: number of worker processes
+        :type  jobs: int
+        """
+        keys = list(corpus.keys() if keys is None else keys)
+        if jobs <= 1 or len(keys) < 2:
+            return dict((k, cls.from_doc(corpus, k)) for k in keys)
+
+        pool = multiprocessing.Pool(processes=jobs,
+                                    initializer=_init_graph_builder,
+                                    initargs=(cls, corpus))
+        try:
+            results = pool.map(_build_graph_data, keys)
+        finally:
+            pool.close()
+            pool.join()
+        return dict((k, cls.from_data(corpus, k, data))
+                    for k, data in zip(keys, results))
+
+    def to_data(self):
+        """
+        A compact representation of this graph made of plain Python
+        values (ie. easy to pickle or send between processes): its
+        nodes, hyperedges, links and attributes, with annotations
+        replaced by references to their local ids.
+
+        We also note which annotations the graph's `doc` is made of,
+        in case it is a modified view of the original document (see
+        eg. `educe.stac.graph.Graph.without_cdus`).
+
+        See `from_data` to turn it back into a graph
+        """
+        def strip(attrs):
+            attrs = dict(attrs)
+            if attrs.get('annotation') is not None:
+                attrs['annotation'] = _annotation_ref(attrs['annotation'])
+            return attrs
+        nodes = [ (n, strip(self.node_attributes(n))) for n in self.nodes() ]
+        edges = [ (e, strip(self.edge_attributes(e)), list(self.links(e)))
+                  for e in self.hyperedges() ]
+        return { 'version' : _GRAPH_DATA_VERSION
+               , 'nodes'   : nodes
+               , 'edges'   : edges
+               , 'doc'     : _document_refs(self.doc)
+               }
+
+    @classmethod
+    def from_data(cls, corpus, doc_key, data):
+        """
+        Rebuild a graph from the output of `to_data`, using the
+        annotations in the given document.
+
+        If the graph refers to relation instances whose endpoints
+        are not the ones in the document (see eg.
+        `educe.stac.graph.Graph.without_cdus`), those relations are
+        replaced by shallow copies that point to the right endpoints.
+
+        If the graph was made on a modified view of the document (ie.
+        if it is not made of the same annotations), we make the same
+        view again (a shallow copy of the document, with
+        the annotations noted by `to_data`), along with a copy of the
+        corpus dictionary that points to it
+        """
+        if data.get('version') != _GRAPH_DATA_VERSION:
+            raise Exception('Unknown graph data version: %s' %
+                            data.get('version'))
+        self         = cls()
+        doc          = corpus[doc_key]
+        self.corpus  = corpus
+        self.doc_key = doc_key
+        self.doc     = doc
+
+        resolver = _AnnotationResolver(doc)
+        view     = data['doc']
+        if view != _document_refs(doc):
+            doc2           = copy.copy(doc)
+            doc2.units     = map(resolver.resolve, view['units'])
+            doc2.relations = map(resolver.resolve, view['relations'])
+            doc2.rels      = doc2.relations
+            doc2.schemas   = map(resolver.resolve, view['schemas'])
+            self.doc       = doc2
+            self.corpus    = dict(corpus)
+            self.corpus[doc_key] = doc2
+
+        def unstrip(attrs):
+            ref = attrs.get('annotation')
+            if ref is not None:
+                attrs['annotation'] = resolver.resolve(ref)
+            return attrs.items()
+
+        for node, attrs in data['nodes']:
+            self.add_node(node)
+            for x in unstrip(attrs):
+                self.add_node_attribute(node, x)
+        for edge, attrs, links in data['edges']:
+            self.add_edge(edge)
+            self.add_edge_attributes(edge, unstrip(attrs))
+            for l in links: self.link(l, edge)
+        resolver.fleshout()
+        return self
+
+    def apply_delta(self, added=None, removed=None, modified=None,
+                    pred=lambda x:True):
+        """
+        Update the graph to reflect changes to its document, without
+        rebuilding it from scratch. The graph should end up looking
+        the same as if you had called `from_doc` on the modified
+        document.
+
+        The document itself is not touched: it should already contain
+        the added and modified annotations (and no longer contain the
+        removed ones) by the time you call this.
+
+        EDUs are added to the graph when something new points to them,
+        and dropped when nothing does any more.
+
+        :param added: new units, relation instances and schemas
+        :param removed: annotations no longer in the document
+        :param modified: annotations that have changed (eg. relations
+            with new endpoints, or CDUs with new members); these should
+            have the same local ids as the objects they replace
+
+        :param pred: the predicate the graph was built with (see
+            `from_doc`)
+        :type  pred: annotation -> boolean
+        """
+        added    = list(added    or [])
+        removed  = list(removed  or [])
+        modified = list(modified or [])
+        removed.extend(x for x in modified if not pred(x))
+        modified = [ x for x in modified if pred(x) ]
+        added    = [ x for x in added    if pred(x) ]
+
+        for anno in added:
+            node_id = self._mk_node_id(anno.local_id())
+            if self.has_node(node_id):
+                raise DuplicateIdException(node_id)
+
+        # EDUs that may have lost their last link
+        orphans = set()
+
+        def detach(anno):
+            edge_id = self._mk_edge_id(anno.local_id())
+            if self.has_edge(edge_id):
+                orphans.update(self.links(edge_id))
+                self.del_hyperedge(edge_id)
+
+        for anno in removed:
+            detach(anno)
+            node_id = self._mk_node_id(anno.local_id())
+            if self.has_node(node_id):
+                self.del_node(node_id)
+        for anno in modified:
+            detach(anno)
+
+        nodes = []
+        edges = []
+        for anno in added + modified:
+            kind = _annotation_kind(anno)
+            if kind == 'relation':
+                nodes.append(self._rel_node(anno))
+                edges.append(self._rel_edge(anno))
+            elif kind == 'schema':
+                nodes.append(self._schema_node(anno))
+                edges.append(self._schema_edge(anno))
+            else:
+                # only included in the graph if pointed to (below)
+                node = self._unit_node(anno)
+                if self.has_node(node[0]):
+                    nodes.append(node)
+
+        for node, attrs in nodes:
+            if self.has_node(node):
+                self._clear_node_attributes(node)
+            else:
+                self.add_node(node)
+            for x in attrs.items():
+                self.add_node_attribute(node, x)
+
+        units = None
+        for edge, attrs, links in edges:
+            if self.has_edge(edge):
+                continue
+            self.add_edge(edge)
+            self.add_edge_attributes(edge, attrs.items())
+            for l in links:
+                if not self.has_node(l):
+                    if units is None:
+                        units = dict((self._mk_node_id(x.local_id()), x)
+                                     for x in self.doc.units if pred(x))
+                    node, node_attrs = self._unit_node(units[l])
+                    self.add_node(node)
+                    for x in node_attrs.items():
+                        self.add_node_attribute(node, x)
+                self.link(l, edge)
+
+        for n in orphans:
+            if self.has_node(n) and not self._node_edges(n) and\
+                    self._node_attrs_view(n).get('type') == 'EDU':
+                self.del_node(n)
+
+        self._invalidate_indexes()
+
     def copy(self, nodeset=None):
         """
         Return a copy of the graph, optionally restricted to a subset
@@ -309,11 +796,6 @@ class Graph(gr.hypergraph, AttrsMixin):
         :param nodeset: only copy nodes with these names
         :type  nodeset: iterable of strings
         """
-        g=Graph()
-        g.corpus  = self.corpus
-        g.doc_key = self.doc_key
-        g.doc     = self.doc
-
         if nodeset is None:
             nodes_wanted = set(self.nodes())
         else:
@@ -323,90 +805,228 @@ class Graph(gr.hypergraph, AttrsMixin):
         for x in cdus:
             nodes_wanted.update(self.cdu_members(x, deep=True))
 
-        def is_wanted_edge(e):
-            return all([l in nodes_wanted for l in self.links(e)])
-
-        # keep expanding the copyable edge list until we've
-        # covered everything that exclusively points
-        # (indirectly or otherwise) to our copy set
-        keep_growing    = True
-        edges_remaining = self.hyperedges()
-        edges_wanted    = set()
-        while keep_growing:
-            keep_growing = False
-            for e in edges_remaining:
-                if is_wanted_edge(e):
-                    edges_wanted.add(e)
-                    nodes_wanted.add(self.mirror(e)) # obligatory node mirror
-                    edges_remaining.remove(e)
-                    keep_growing = True
-
+        # worklist: an edge becomes wanted once all of its links are;
+        # wanting an edge means wanting its mirror node, which may in
+        # turn complete the links of other edges pointing to it
+        missing   = {}
+        worklist  = []
+        for e in self.hyperedges():
+            missing[e] = len([l for l in self.links(e) if l not in nodes_wanted])
+            if missing[e] == 0:
+                worklist.append(e)
+
+        edges_wanted = set()
+        while worklist:
+            e = worklist.pop()
+            edges_wanted.add(e)
+            n = self._edge_attrs_view(e).get('mirror') # obligatory node mirror
+            if n is None or n in nodes_wanted:
+                continue
+            nodes_wanted.add(n)
+            if self.has_node(n):
+                for e2 in self._node_edges(n):
+                    missing[e2] -= 1
+                    if missing[e2] == 0:
+                        worklist.append(e2)
+
+        g = self._empty_copy()
         for n in self.nodes():
             if n in nodes_wanted:
-                g.add_node(n)
-                for kv in self.node_attributes(n):
-                    g.add_node_attribute(n,kv)
-
+                self._copy_node(g, n)
         for e in self.hyperedges():
             if e in edges_wanted:
-                g.add_hyperedge(e)
-                for kv in self.edge_attributes(e):
-                    g.add_edge_attribute(e,kv)
-                for l in self.links(e):
-                    g.link(l,e)
+                self._copy_edge(g, e)
+        return g
+
+    def split_components(self):
+        """
+        Return a list of subgraphs, one for each connected component
+        (see `connected_components`), ordered by their smallest node.
 
+        This is like calling `copy` on each component, but all of the
+        subgraphs are built in one pass over the graph. Hyperedges
+        without any links go with the component of their mirror node
+        """
+        roots = self._component_roots()
+        order = {}
+        for n in sorted(roots):
+            order.setdefault(roots[n], len(order))
+        subgraphs = [ self._empty_copy() for _ in order ]
+
+        for n in self.nodes():
+            self._copy_node(subgraphs[order[roots[n]]], n)
+        for e in self.hyperedges():
+            links = self.links(e)
+            if links:
+                anchor = links[0]
+            else:
+                anchor = self._edge_attrs_view(e).get('mirror')
+                if anchor not in roots:
+                    continue
+            self._copy_edge(subgraphs[order[roots[anchor]]], e)
+        return subgraphs
+
+    def _empty_copy(self):
+        g=type(self)()
+        g.corpus  = self.corpus
+        g.doc_key = self.doc_key
+        g.doc     = self.doc
         return g
 
+    def _copy_node(self, g, n):
+        g.add_node(n)
+        for kv in self.node_attributes(n):
+            g.add_node_attribute(n,kv)
+
+    def _copy_edge(self, g, e):
+        g.add_hyperedge(e)
+        for kv in self.edge_attributes(e):
+            g.add_edge_attribute(e,kv)
+        for l in self.links(e):
+            g.link(l,e)
+
     def connected_components(self):
         """
         Return a set of a connected components.
 
         Each connected component set can be passed to `self.copy()`
-        to be copied as a subgraph.
+        to be copied as a subgraph (or see `split_components`)
 
-        This builds on python-graph's version of a function with the
+        This is like python-graph's version of a function with the
         same name but also adds awareness of our conventions about there
-        being both a node/edge for relations/CDUs.
+        being both a node/edge for relations/CDUs: anything connected
+        *via* an edge is also considered to be connected *to* the edge
+        (ie. to its mirror node)
         """
-        ccs       = accessibility.connected_components(self)
         subgraphs = collections.defaultdict(list)
-        for x,c in ccs.items():
-            subgraphs[c].append(x)
-
-        # the basic idea here: if any member of connected component is
-        # one of our hybrid node/edge creatures, we need to help the
-        # graph library recognise that that anything connected *via*
-        # the edge should also be considered as connected *to* the
-        # edge, so we merge the components
-        eaten  = set ()
-        merged = {}
-        prior  = subgraphs.keys()
-        while sorted(merged.keys()) != prior:
-            prior     = sorted(merged.keys())
-            merged    = {}
-            for k in subgraphs:
-                if k in eaten: continue
-                cc = subgraphs[k]
-                merged[k] = copy.copy(cc)
-                for n in cc:
-                    e = self.mirror(n)
-                    if e is not None:
-                        links = set(self.links(e))
-                        for k2 in subgraphs.keys():
-                            links2 = set(subgraphs[k2])
-                            if k2 != k and not links2.isdisjoint(links):
-                                eaten.add(k2)
-                                merged[k].extend(links2)
-            subgraphs = merged
-
-        ccs = frozenset([frozenset(v) for v in subgraphs.values()])
-        return ccs
+        for n, root in self._component_roots().items():
+            subgraphs[root].append(n)
+        return frozenset(frozenset(v) for v in subgraphs.values())
+
+    def _component_roots(self):
+        """
+        Dictionary from each node to a representative of its
+        connected component (see `connected_components`)
+        """
+        # union-find over nodes (with path halving)
+        parent = dict((n, n) for n in self.nodes())
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+        def union(x, y):
+            rx, ry = find(x), find(y)
+            if rx != ry:
+                parent[ry] = rx
+
+        for e in self.hyperedges():
+            links = self.links(e)
+            for l in links[1:]:
+                union(links[0], l)
+
+        for n in parent.keys():
+            e = self._node_attrs_view(n).get('mirror')
+            if e is not None and self.has_edge(e):
+                for l in self.links(e):
+                    union(n, l)
+
+        return dict((n, find(n)) for n in parent)
+
+    def to_matrices(self, labels=None):
+        """
+        Return a `GraphMatrices` view of this graph: sparse matrices
+        (in scipy's CSR format) for its relations and CDU membership,
+        along with the lists of nodes and annotations they refer to.
+
+        Relations that do not link discourse units (ie. relations
+        between relations) are left out, as are all but the first
+        (in order of their hyperedge ids) of several relations
+        between the same pair of units.
+
+        This needs numpy and scipy.
+
+        :param labels: relation labels to number first (in this
+            order), so that label ids agree across documents; other
+            labels are numbered after them as we see them
+        :type  labels: list of strings
+        """
+        import numpy
+        import scipy.sparse
+
+        def position(x):
+            sp = self.annotation(x).text_span()
+            if sp is None:
+                return (1, 0, 0, x)
+            else:
+                return (0, sp.char_start, 0 - sp.char_end, x)
+
+        edus  = sorted(self.edus(), key=position)
+        cdus  = sorted((self.mirror(e) for e in self.cdus()), key=position)
+        nodes = edus + cdus
+        index = dict((x, i) for i, x in enumerate(nodes))
+
+        label_list = [None] + list(labels or [])
+        label_ids  = dict((l, i) for i, l in enumerate(label_list) if i > 0)
+        pairs      = {}
+        rel_edges  = []
+        skipped    = []
+        for e in sorted(self.relations()):
+            links = self.links(e)
+            if len(links) != 2 or not all(l in index for l in links):
+                skipped.append(e)
+                continue
+            pair = (index[links[0]], index[links[1]])
+            if pair in pairs:
+                skipped.append(e)
+                continue
+            label = self.annotation(e).type
+            if label not in label_ids:
+                label_ids[label] = len(label_list)
+                label_list.append(label)
+            pairs[pair] = label_ids[label]
+            rel_edges.append(e)
+
+        # row-major order, ie. the order of the matrix entries
+        def key(e):
+            return (index[self.links(e)[0]], index[self.links(e)[1]])
+        rel_edges.sort(key=key)
+        keys = [ key(e) for e in rel_edges ]
+        size = len(nodes)
+        rel_matrix = scipy.sparse.csr_matrix(
+            (numpy.array([pairs[k] for k in keys], dtype=numpy.int32),
+             (numpy.array([k[0] for k in keys], dtype=numpy.int32),
+              numpy.array([k[1] for k in keys], dtype=numpy.int32))),
+            shape=(size, size))
+        rel_matrix.sort_indices()
+
+        rows = []
+        cols = []
+        for i, n in enumerate(cdus):
+            for m in self.cdu_members(n):
+                if m in index:
+                    rows.append(i)
+                    cols.append(index[m])
+        cdu_matrix = scipy.sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int8),
+             (numpy.array(rows, dtype=numpy.int32),
+              numpy.array(cols, dtype=numpy.int32))),
+            shape=(len(cdus), size))
+
+        return GraphMatrices(nodes=nodes,
+                             annotations=[self.annotation(x) for x in nodes],
+                             num_edus=len(edus),
+                             labels=label_list,
+                             relations=rel_matrix,
+                             relation_edges=rel_edges,
+                             skipped_relations=skipped,
+                             cdu_members=cdu_matrix)
 
     def _attrs(self, x):
         if self.has_edge(x):
-            return self.edge_attributes_dict(x)
+            return self._edge_attrs_view(x)
         elif self.has_node(x):
-            return self.node_attributes_dict(x)
+            return self._node_attrs_view(x)
         else:
             raise Exception('Tried to get attributes of non-existing object ' + x)
 
@@ -416,14 +1036,14 @@ class Graph(gr.hypergraph, AttrsMixin):
         By convention, the first link is considered the source and the
         the second is considered the target.
         """
-        xs = [ e for e in self.hyperedges() if self.is_relation(e) ]
+        xs = [ e for e in self._candidate_edges('rel') if self.is_relation(e) ]
         return frozenset(xs)
 
     def edus(self):
         """
         Set of nodes representing elementary discourse units
         """
-        xs = [ e for e in self.nodes() if self.is_edu(e) ]
+        xs = [ e for e in self._candidate_nodes('EDU') if self.is_edu(e) ]
         return frozenset(xs)
 
     def cdus(self):
@@ -432,7 +1052,7 @@ class Graph(gr.hypergraph, AttrsMixin):
 
         See also `cdu_members`
         """
-        xs = [ e for e in self.hyperedges() if self.is_cdu(e) ]
+        xs = [ e for e in self._candidate_edges('CDU') if self.is_cdu(e) ]
         return frozenset(xs)
 
     def containing_cdu(self, node):
@@ -442,9 +1062,15 @@ class Graph(gr.hypergraph, AttrsMixin):
         If there is more than one containing CDU, return one of them
         arbitrarily.
         """
-        for e in self.links(self.nodeform(node)):
-            if self.is_cdu(e): return e
-        return None
+        return self._cdus().parent.get(self.nodeform(node))
+
+    def cdu_depth(self, node):
+        """
+        Given an EDU (or CDU, or relation instance), return the number
+        of CDUs it is (transitively) contained in, following
+        `containing_cdu`
+        """
+        return self._cdus().depth(self.nodeform(node))
 
     def cdu_members(self, cdu, deep=False):
         """
@@ -455,17 +1081,67 @@ class Graph(gr.hypergraph, AttrsMixin):
         members of the CDU.  If `deep==True`, also return members of CDUs
         that are members of (members of ..) this CDU.
         """
-
+        hyperedge = self.edgeform(cdu)
         if deep:
-            members = set()
-            for m in self.cdu_members(cdu):
-                members.add(m)
-                if self.is_cdu(m):
-                    members.update(self.cdu_members(m,deep))
-            return frozenset(members)
+            return self._cdus().deep_members(hyperedge)
         else:
-            hyperedge = self.edgeform(cdu)
-            return frozenset(self.links(hyperedge))
+            return self._cdus().members(hyperedge)
+
+    # --------------------------------------------------
+    # indexes
+    # --------------------------------------------------
+
+    def _cdus(self):
+        """
+        CDU containment index, built on demand and thrown away
+        whenever the graph changes
+        """
+        if getattr(self, '_cdu_index', None) is None:
+            self._cdu_index = CduIndex(self)
+        return self._cdu_index
+
+    def _invalidate_indexes(self):
+        """
+        Forget anything we have computed about the structure of
+        this graph (called by any method which modifies it)
+        """
+        self._cdu_index = None
+
+    def add_node(self, node):
+        self._invalidate_indexes()
+        return super(Graph, self).add_node(node)
+
+    def del_node(self, node):
+        self._invalidate_indexes()
+        return super(Graph, self).del_node(node)
+
+    def add_hyperedge(self, hyperedge):
+        self._invalidate_indexes()
+        return super(Graph, self).add_hyperedge(hyperedge)
+
+    def del_hyperedge(self, hyperedge):
+        self._invalidate_indexes()
+        return super(Graph, self).del_hyperedge(hyperedge)
+
+    def link(self, node, hyperedge):
+        self._invalidate_indexes()
+        return super(Graph, self).link(node, hyperedge)
+
+    def unlink(self, node, hyperedge):
+        self._invalidate_indexes()
+        return super(Graph, self).unlink(node, hyperedge)
+
+    def add_node_attribute(self, node, attr):
+        self._invalidate_indexes()
+        return super(Graph, self).add_node_attribute(node, attr)
+
+    def add_edge_attribute(self, edge, attr):
+        self._invalidate_indexes()
+        return super(Graph, self).add_edge_attribute(edge, attr)
+
+    # --------------------------------------------------
+    # identifiers
+    # --------------------------------------------------
 
     def _mk_guid(self, x):
         return self.doc_key.mk_global_id(x)
@@ -528,6 +1204,294 @@ class Graph(gr.hypergraph, AttrsMixin):
         return self._mk_edge(anno, 'CDU', anno.span, mirrored=True)
 
 
+class GraphMatrices:
+    """
+    Sparse matrix view of a discourse graph (see `Graph.to_matrices`).
+    Row/column `i` in the discourse unit dimension refers to `nodes[i]`
+
+    * nodes: the graph nodes for the discourse units, EDUs (in textual
+      order) first, then CDUs (likewise)
+    * annotations: the annotation for each of the nodes
+    * num_edus: how many of the nodes are EDUs
+    * labels: relation labels; label id `i` stands for `labels[i]`
+      (id 0 means no relation, so `labels[0]` is None)
+    * relations: (DU x DU) matrix of label ids, from source to target
+    * relation_edges: hyperedges of the relations in the matrix,
+      in row-major order (aligned with `relations.data`)
+    * skipped_relations: hyperedges of the relations not in the matrix
+    * cdu_members: (CDU x DU) matrix with a 1 wherever a DU is
+      an immediate member of a CDU; row `i` is the CDU
+      `nodes[num_edus + i]`
+    """
+    def __init__(self, nodes, annotations, num_edus, labels,
+                 relations, relation_edges, skipped_relations,
+                 cdu_members):
+        self.nodes             = nodes
+        self.annotations       = annotations
+        self.num_edus          = num_edus
+        self.labels            = labels
+        self.relations         = relations
+        self.relation_edges    = relation_edges
+        self.skipped_relations = skipped_relations
+        self.cdu_members       = cdu_members
+
+class CduIndex(object):
+    """
+    CDU containment forest of a `Graph`, which you would normally
+    access via `Graph.containing_cdu`, `Graph.cdu_depth` and
+    `Graph.cdu_members`.
+
+    The parent of each node (the first CDU hyperedge it is linked
+    to) is computed up front; depths and (deep) members are computed
+    as they are asked for, and remembered. The index assumes the
+    graph does not change (the graph discards it if it does)
+    """
+    def __init__(self, graph):
+        self.graph   = graph
+        self.parent  = {} # node -> hyperedge
+        self._depth  = {}
+        self._shallow = {}
+        self._deep    = {}
+        for n in graph.nodes():
+            for e in graph._node_edges(n):
+                if graph.is_cdu(e):
+                    self.parent[n] = e
+                    break
+
+    def members(self, edge):
+        """
+        Immediate members of a CDU hyperedge
+        """
+        if edge not in self._shallow:
+            self._shallow[edge] = frozenset(self.graph.links(edge))
+        return self._shallow[edge]
+
+    def deep_members(self, edge):
+        """
+        Members of a CDU hyperedge and (recursively) of the CDUs
+        within it
+        """
+        if edge in self._deep:
+            return self._deep[edge]
+        graph   = self.graph
+        members = set()
+        seen    = set([edge])
+        stack   = [edge]
+        while stack:
+            e = stack.pop()
+            if e != edge and e in self._deep:
+                members.update(self._deep[e])
+                continue
+            for m in self.members(e):
+                members.add(m)
+                if graph.is_cdu(m):
+                    e2 = graph.edgeform(m)
+                    if e2 not in seen:
+                        seen.add(e2)
+                        stack.append(e2)
+        self._deep[edge] = frozenset(members)
+        return self._deep[edge]
+
+    def depth(self, node):
+        """
+        Number of CDUs enclosing this node (stopping short if
+        the containment relation turns out to have a cycle)
+        """
+        if node in self._depth:
+            return self._depth[node]
+        chain = []
+        seen  = set()
+        n     = node
+        while n not in self._depth and n not in seen:
+            seen.add(n)
+            chain.append(n)
+            e = self.parent.get(n)
+            n = self.graph._edge_attrs_view(e).get('mirror') if e is not None else None
+            if n is None:
+                break
+        depth = self._depth.get(n, 0) if n is not None else -1
+        for x in reversed(chain):
+            depth += 1
+            self._depth[x] = depth
+        return self._depth[node]
+
+def _annotation_kind(anno):
+    """
+    'unit', 'relation' or 'schema'
+    """
+    if isinstance(anno, annotation.Relation):
+        return 'relation'
+    elif isinstance(anno, annotation.Schema):
+        return 'schema'
+    else:
+        return 'unit'
+
+_GRAPH_DATA_VERSION = 2
+
+def _annotation_ref(anno):
+    """
+    A (picklable) way to refer to an annotation within its document.
+    For relation instances, we also note the endpoints, which may
+    differ from those of the relation in the document
+    """
+    kind = _annotation_kind(anno)
+    if kind == 'relation':
+        return kind, anno.local_id(), anno.span.t1, anno.span.t2
+    else:
+        return kind, anno.local_id()
+
+def _document_refs(doc):
+    """
+    `_annotation_ref`s for all the annotations in a document
+    """
+    return { 'units'     : map(_annotation_ref, doc.units)
+           , 'relations' : map(_annotation_ref, doc.relations)
+           , 'schemas'   : map(_annotation_ref, doc.schemas)
+           }
+
+class _AnnotationResolver:
+    """
+    Turns `_annotation_ref`s back into the annotations of a document.
+
+    Relation instances whose endpoints differ from the document's are
+    replaced by shallow copies (one per reference, however many times
+    we are asked for it). Call `fleshout` once everything is resolved
+    to point these copies at their endpoints, which are themselves
+    copies where we have made any
+    """
+    def __init__(self, doc):
+        self.annos  = { 'unit'     : dict((x.local_id(), x) for x in doc.units)
+                      , 'relation' : dict((x.local_id(), x) for x in doc.relations)
+                      , 'schema'   : dict((x.local_id(), x) for x in doc.schemas)
+                      }
+        self.copies = {}
+
+    def resolve(self, ref):
+        anno = self.annos[ref[0]][ref[1]]
+        if ref[0] != 'relation' or (anno.span.t1, anno.span.t2) == ref[2:]:
+            return anno
+        if ref not in self.copies:
+            anno      = copy.copy(anno)
+            anno.span = annotation.RelSpan(*ref[2:])
+            self.copies[ref] = anno
+        return self.copies[ref]
+
+    def fleshout(self):
+        retargeted = dict((ref[1], x) for ref, x in self.copies.items())
+        def endpoint(local_id):
+            if local_id in retargeted:
+                return retargeted[local_id]
+            for kind in ['unit', 'schema', 'relation']:
+                if local_id in self.annos[kind]:
+                    return self.annos[kind][local_id]
+            return None
+        for x in self.copies.values():
+            x.source = endpoint(x.span.t1)
+            x.target = endpoint(x.span.t2)
+
+# worker process state for Graph.from_corpus
+_graph_builder_args = None
+
+def _init_graph_builder(cls, corpus):
+    global _graph_builder_args
+    _graph_builder_args = (cls, corpus)
+
+def _build_graph_data(key):
+    cls, corpus = _graph_builder_args
+    return cls.from_doc(corpus, key).to_data()
+
+class IndexedGraph(Graph, IndexedHypergraph):
+    """
+    `Graph` on the `IndexedHypergraph` backend. It behaves the same
+    way, but type checks and attribute lookups are cheaper, which is
+    useful on larger documents
+    """
+    pass
+
+
+# ---------------------------------------------------------------------
+# caching
+# ---------------------------------------------------------------------
+
+def document_fingerprint(doc):
+    """
+    Hash of the parts of a document that go into its graph (the
+    local ids, types and spans of its annotations), so that we can
+    tell if a saved graph is out of date
+    """
+    h = hashlib.sha1()
+    for kind, annos in [ ('unit',     doc.units)
+                       , ('relation', doc.relations)
+                       , ('schema',   doc.schemas) ]:
+        for x in annos:
+            sp = x.span
+            if isinstance(sp, annotation.Span):
+                sp = (sp.char_start, sp.char_end)
+            elif isinstance(sp, annotation.RelSpan):
+                sp = (sp.t1, sp.t2)
+            else:
+                sp = sorted(sp)
+            h.update(repr((kind, x.local_id(), x.type, sp)))
+    return h.hexdigest()
+
+class GraphCache:
+    """
+    Graphs saved on disk (in their `Graph.to_data` form), so that
+    scripts which repeatedly work with the graphs of the same
+    documents can skip building them.
+
+    Saved graphs are keyed on the document key, the graph class and
+    an optional variant name (for graphs built some other way than
+    with `from_doc`, eg. with CDUs stripped away). They are rebuilt if
+    the document changes (see `document_fingerprint`)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, graph_class, doc_key, variant):
+        key = (doc_key.doc, doc_key.subdoc, doc_key.stage, doc_key.annotator,
+               graph_class.__module__, graph_class.__name__, variant)
+        return os.path.join(self.directory,
+                            hashlib.sha1(repr(key)).hexdigest() + '.graph')
+
+    def get(self, graph_class, corpus, doc_key, variant=None, build=None):
+        """
+        Return the graph for a document, either from the cache or by
+        building (and then saving) it.
+
+        :param build: how to build the graph (default: `from_doc`);
+            you should give different builders different variant names
+        :type  build: (corpus, `FileId`) -> `Graph`
+        """
+        path        = self._path(graph_class, doc_key, variant)
+        fingerprint = document_fingerprint(corpus[doc_key])
+        saved = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    saved = pickle.load(f)
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                saved = None # unreadable, rebuild it
+        if saved is not None and\
+                saved.get('fingerprint') == fingerprint and\
+                saved['data'].get('version') == _GRAPH_DATA_VERSION:
+            return graph_class.from_data(corpus, doc_key, saved['data'])
+
+        if build is None:
+            graph = graph_class.from_doc(corpus, doc_key)
+        else:
+            graph = build(corpus, doc_key)
+        saved = { 'fingerprint' : fingerprint
+                , 'data'        : graph.to_data()
+                }
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        return graph
+
 # ---------------------------------------------------------------------
 # visualisation
 # ---------------------------------------------------------------------
@@ -714,13 +1678,14 @@ class DotGraph(pydot.Dot):
             attrs['label'] = 'CDU'
         subg = pydot.Subgraph(self._dot_id(hyperedge), **attrs)
         local_nodes  = self.core.links(hyperedge)
+        local_set    = frozenset(local_nodes)
         local_nodes2 = []
 
         # take into account links to relations (sigh)
         def is_enclosed(l):
             return l != hyperedge and\
                     l in self.complex_rels and\
-                    all( [x in local_nodes for x in self.core.links(l)] )
+                    all( [x in local_set for x in self.core.links(l)] )
         for node in local_nodes:
             if self.core.is_relation(node):
                 local_nodes2.append(node)
@@ -780,31 +1745,35 @@ class DotGraph(pydot.Dot):
         pydot.Dot.__init__(self, compound='true')
         self.set_name('hypergraph')
 
-        # rels which are the target of links
+        # rels which are the target of links (ie. whose node is
+        # linked, along with some other node, to a relation or CDU)
         self.complex_rels = set()
-        for n in self.core.nodes():
-            for n2 in self.core.neighbors(n):
+        for e in self.core.hyperedges():
+            links = self.core.links(e)
+            if len(links) < 2:
+                continue
+            for n2 in links:
                 if self.core.is_relation(n2):
-                    e2 = self.core.mirror(n2)
-                    self.complex_rels.add(e2)
+                    self.complex_rels.add(self.core.mirror(n2))
 
-        # CDUs which overlap other CDUs
+        # CDUs which overlap other CDUs (ie. which have a member
+        # that belongs to more than one CDU)
         #self.complex_cdus = self.core.cdus()
+        cdus        = self.core.cdus()
+        cdu_members = dict((e, self.core.cdu_members(e)) for e in cdus)
+        cdu_count   = collections.defaultdict(int)
+        for members in cdu_members.values():
+            for n in members:
+                cdu_count[n] += 1
         self.complex_cdus = set()
-        for e in self.core.cdus():
-            members       = self.core.cdu_members(e)
-            other_members = set()
-            for e2 in self.core.cdus():
-                if e != e2: other_members.update(self.core.cdu_members(e2))
-            def is_complex(n):
-                return n in other_members
-            if any([is_complex(n) for n in members]):
+        for e in cdus:
+            if any(cdu_count[n] > 1 for n in cdu_members[e]):
                 self.complex_cdus.add(e)
 
         # CDUs which are contained in another
         self.contained_cdus = set()
-        for e in self.core.cdus():
-            for n2 in self.core.cdu_members(e):
+        for e in cdus:
+            for n2 in cdu_members[e]:
                 e2 = self.core.mirror(n2)
                 if self.core.is_cdu(n2) and e2 not in self.complex_cdus:
                     self.contained_cdus.add(e2)
@@ -828,7 +1797,7 @@ class DotGraph(pydot.Dot):
             else:
                 self._add_simple_rel(edge)
 
-        for edge in self.core.cdus():
+        for edge in cdus:
             if edge in self.contained_cdus:
                 continue
             elif edge in self.complex_cdus:
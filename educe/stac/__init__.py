@@ -69,9 +69,10 @@ There is a typology of unit types worth noting:
 from educe.corpus import *
 from glob import glob
 import copy
-from   educe.annotation import Unit, Relation, Schema
+from   educe.annotation import Unit, Relation, Schema, Span
 import educe.corpus
 import educe.glozz as glozz
+import bisect
 import itertools
 import math
 import os
@@ -104,6 +105,8 @@ coordinating_relations =\
    , 'Alternation'
    ]
 
+_TURN_PREFIX_RE = re.compile(r'(^[0-9]+ ?: .*? ?: )(.*)$')
+
 def split_turn_text(t):
     """
     STAC turn texts are prefixed with a turn number and speaker
@@ -116,9 +119,10 @@ def split_turn_text(t):
     your go, Alice").
 
     Mind your offsets! They're based on the whole turn string.
+    If you are working with the turns of a document, `turn_table`
+    has done this for you.
     """
-    prefix_re = re.compile(r'(^[0-9]+ ?: .*? ?: )(.*)$')
-    match     = prefix_re.match(t)
+    match = _TURN_PREFIX_RE.match(t)
     if match:
         return (match.group(1),match.group(2))
     else:
@@ -126,6 +130,104 @@ def split_turn_text(t):
         # it's a sign that something weird has happened
         raise Exception("Turn does not start with number/speaker prefix: " + t)
 
+class TurnInfo:
+    """
+    A turn in a document (see `turn_table`)
+
+    * turn: the turn annotation
+    * prefix_len: length of its number/speaker prefix (see
+      `split_turn_text`)
+    * body_span: span of the turn text proper (without the prefix)
+    * speaker: the turn's emitter (None if it has no such feature)
+    * identifier: the turn number, as given in the prefix
+    * well_formed: False if the turn text does not have the usual
+      prefix, in which case we treat the whole text as the body (and
+      the identifier is None)
+    """
+    def __init__(self, turn, prefix_len, body_span, speaker, identifier,
+                 well_formed=True):
+        self.turn        = turn
+        self.prefix_len  = prefix_len
+        self.body_span   = body_span
+        self.speaker     = speaker
+        self.identifier  = identifier
+        self.well_formed = well_formed
+
+class TurnTable:
+    """
+    The turns in a document, ordered by span, as a list of `TurnInfo`
+    (`infos`), along with a means to find the turn enclosing any
+    given span (`enclosing`).
+
+    Use `turn_table` to get one of these
+    """
+    def __init__(self, doc):
+        self.infos = []
+        for turn in sorted(filter(is_turn, doc.units), key=lambda t:t.span):
+            text  = doc.text(turn.span)
+            match = _TURN_PREFIX_RE.match(text)
+            if match:
+                prefix, body = match.group(1), match.group(2)
+                identifier   = prefix.split(':')[0].strip()
+            else:
+                # one odd turn should not stop us from reading the rest
+                prefix, body = '', text
+                identifier   = None
+            body_start = turn.span.char_start + len(prefix)
+            body_span  = Span(body_start, body_start + len(body))
+            speaker    = turn.features.get('Emitter')
+            self.infos.append(TurnInfo(turn, len(prefix), body_span,
+                                       speaker, identifier,
+                                       well_formed=bool(match)))
+        self._starts  = [ x.turn.span.char_start for x in self.infos ]
+        # furthest end point of any turn up to this one (so that we
+        # know when to stop looking back for an enclosing turn)
+        self._max_end = []
+        for x in self.infos:
+            end = x.turn.span.char_end
+            if self._max_end:
+                end = max(end, self._max_end[-1])
+            self._max_end.append(end)
+
+    def __iter__(self):
+        return iter(self.infos)
+
+    def __len__(self):
+        return len(self.infos)
+
+    def enclosing(self, span):
+        """
+        The `TurnInfo` of the first turn that encloses the given span,
+        or None if there is no such turn
+        """
+        i   = bisect.bisect_right(self._starts, span.char_start) - 1
+        res = None
+        while i >= 0 and self._max_end[i] >= span.char_end:
+            if self.infos[i].turn.span.encloses(span):
+                res = self.infos[i]
+            i -= 1
+        return res
+
+def turn_table(doc, refresh=False):
+    """
+    Return the `TurnTable` for a document. This is computed once and
+    remembered on the document, until its list of units is replaced
+    or grows or shrinks (checking for this is cheap, so you can call
+    this as often as you like).
+
+    If you modify the units in place (eg. replacing or moving a turn,
+    or changing its emitter), pass `refresh=True` to compute the table
+    again
+    """
+    cached = getattr(doc, '_stac_turn_table', None)
+    if cached is not None and not refresh:
+        units, size, table = cached
+        if units is doc.units and size == len(doc.units):
+            return table
+    table = TurnTable(doc)
+    doc._stac_turn_table = (doc.units, len(doc.units), table)
+    return table
+
 # ---------------------------------------------------------------------
 # Document
 # ---------------------------------------------------------------------
@@ -210,14 +312,14 @@ def is_subordinating(annotation):
     """
     See Relation typology above
     """
-    return isinstance(annotation, Schema) and\
+    return isinstance(annotation, Relation) and\
             annotation.type in subordinating_relations
 
 def is_coordinating(annotation):
     """
     See Relation typology above
     """
-    return isinstance(annotation, Schema) and\
+    return isinstance(annotation, Relation) and\
             annotation.type in coordinating_relations
 
 def is_cdu(annotation):
@@ -257,6 +359,9 @@ def twin(corpus, anno, stage='units'):
     The typical use of this would be if you have an EDU in the 'discourse'
     stage and need to get its 'units' stage equvialent to have its
     dialogue act.
+
+    This scans the whole of the twin document; if you are looking for
+    the twins of many annotations, use `twins` or a `TwinIndex` instead
     """
     if anno.origin is None:
         raise Exception('Annotation origin must be set')
@@ -273,6 +378,64 @@ def twin(corpus, anno, stage='units'):
     else:
         return None
 
+def twins(corpus, annos, stage='units'):
+    """
+    Return the twins (see `twin`) of a sequence of annotations, as
+    a list (with None for any annotation that has no twin)
+    """
+    index = TwinIndex(corpus)
+    return [ index.twin(x, stage) for x in annos ]
+
+class TwinIndex:
+    """
+    Alignment of annotations across the stages of a corpus, mapping
+    (doc, subdoc, annotator, local id) to the annotation with that
+    local id in each stage.
+
+    Use this rather than `twin` if you need to look up more than one
+    annotation. Documents are indexed when we first look something up
+    in them, so changes to a document after that are not noticed
+    """
+    def __init__(self, corpus):
+        self.corpus = corpus
+        self._docs  = {}
+
+    def _local_ids(self, key):
+        """
+        Dictionary from local ids to annotations in a document
+        (the first if there is more than one), or None if the
+        document is not in the corpus
+        """
+        if key not in self._docs:
+            if key in self.corpus:
+                ids = {}
+                for x in self.corpus[key].annotations():
+                    ids.setdefault(x.local_id(), x)
+            else:
+                ids = None
+            self._docs[key] = ids
+        return self._docs[key]
+
+    def twin(self, anno, stage='units'):
+        """
+        The equivalent of `anno` in the given stage of the corpus
+        (see `twin`)
+        """
+        if anno.origin is None:
+            raise Exception('Annotation origin must be set')
+        twin_key       = copy.copy(anno.origin)
+        twin_key.stage = stage
+        ids = self._local_ids(twin_key)
+        if ids is None:
+            return None
+        return ids.get(anno.local_id())
+
+    def twins(self, annos, stage='units'):
+        """
+        Return the twins of a sequence of annotations (see `twins`)
+        """
+        return [ self.twin(x, stage) for x in annos ]
+
 # ---------------------------------------------------------------------
 # Corpus
 # ---------------------------------------------------------------------
@@ -502,3 +665,34 @@ def write_annotation_file(anno_filename, doc):
     Write a GlozzDocument to XML in the given path
     """
     glozz.write_annotation_file(anno_filename, doc, settings=stac_output_settings)
+
+def write_annotation_files(corpus, outdir, jobs=1):
+    """
+    Write a whole corpus back out, using the STAC directory layout
+    under `outdir` (see `id_to_path`). Documents whose contents have
+    not changed are skipped.
+
+    See `educe.glozz.write_annotation_files` for details
+    (including the report that is returned)
+
+    :type corpus: dict from `FileId` to `GlozzDocument`
+    """
+    docs = dict((os.path.join(outdir, id_to_path(k)) + '.aa', doc)
+                for k, doc in corpus.items())
+    return glozz.write_annotation_files(docs,
+                                        settings=stac_output_settings,
+                                        jobs=jobs)
+
+def patch_annotation_file(anno_filename, output_filename=None,
+                          additions=None, deletions=None, feature_edits=None):
+    """
+    Apply a few changes to an existing Glozz annotation file without
+    rewriting it from scratch, following STAC output conventions.
+
+    See `educe.glozz.patch_annotation_file` for details
+    """
+    glozz.patch_annotation_file(anno_filename, output_filename,
+                                additions=additions,
+                                deletions=deletions,
+                                feature_edits=feature_edits,
+                                settings=stac_output_settings)
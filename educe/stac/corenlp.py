@@ -65,8 +65,7 @@ def run_pipeline(corpus, outdir, corenlp_dir, split=False):
     txt_files = []
     for k in corpus:
         doc   = corpus[k]
-        turns = sorted(filter(stac.is_turn, doc.units),
-                       key=lambda k:k.span)
+        turns = stac.turn_table(doc)
 
         k_txt           = copy.copy(k)
         k_txt.stage     = 'turns'
@@ -74,8 +73,8 @@ def run_pipeline(corpus, outdir, corenlp_dir, split=False):
 
         if split:
             for turn in turns:
-                ttext = stac.split_turn_text(doc.text_for(turn))[1]
-                tid   = turn.features['Identifier']
+                ttext = doc.text(turn.body_span)
+                tid   = turn.turn.features['Identifier']
                 root  = stac.id_to_path(k_txt) + '_' + tid.zfill(digits[k.doc])
 
                 txt_file = os.path.join(outdir, 'tmp', root + '.txt')
@@ -95,7 +94,7 @@ def run_pipeline(corpus, outdir, corenlp_dir, split=False):
                 os.makedirs(txt_dir)
             with codecs.open(txt_file, 'w', 'utf-8') as f:
                 for turn in turns:
-                    ttext = stac.split_turn_text(doc.text_for(turn))[1]
+                    ttext = doc.text(turn.body_span)
                     print >> f, ttext
             txt_files.append(txt_file)
 
@@ -177,12 +176,12 @@ def parsed_file_name(k, dir):
 def read_corenlp_result(doc, corenlp_doc, tid=None):
     def is_matching_turn(x):
         if tid is None:
-            return stac.is_turn(x)
+            return True
         else:
-            x_tid = x.features['Identifier']
-            return stac.is_turn(x) & tid == x_tid
+            x_tid = x.turn.features['Identifier']
+            return tid == x_tid
 
-    turns     = sorted(filter(is_matching_turn, doc.units), key=lambda k:k.span)
+    turns     = filter(is_matching_turn, stac.turn_table(doc))
     sentences = corenlp_doc.get_ordered_sentence_list()
 
     if len(turns) != len(sentences):
@@ -206,8 +205,7 @@ def read_corenlp_result(doc, corenlp_doc, tid=None):
         # and then shift them back to the right
         sentence_begin = min(t['extent'][0] for t in sentence_toks[sid])
 
-        ttext  = doc.text_for(turn)
-        offset = turn.span.char_start + len(stac.split_turn_text(ttext)[0]) - sentence_begin
+        offset = turn.body_span.char_start - sentence_begin
 
         for t in sentence_toks[sid]:
             tid = t['id']
@@ -0,0 +1,425 @@
+# Author: Eric Kow
+# License: BSD3
+
+"""
+Features for EDUs and EDU pairs, as sparse matrices.
+
+We extract, for each EDU
+
+* its dialogue acts (taken from the `units` stage of the corpus if
+  it is there, see `educe.stac.TwinIndex`)
+* its speaker
+* where it sits in its turn and in the document
+* the words in it (from tokens if we have them, or else from its text)
+
+and for each candidate pair of EDUs (see `educe.stac.pairs`)
+
+* the distance between the EDUs in EDUs, turns and characters
+* whether they are from the same speaker or turn
+* the dialogue acts of either EDU, and the pair of them
+* the label of the relation from the first EDU to the second, if
+  there is one (as a separate array of label ids)
+
+Features go straight into a scipy CSR matrix whose columns are given
+by a `FeatureVocabulary`. The vocabulary grows as we meet new features,
+so the same vocabulary can be used for one batch of documents after
+another, until we freeze it (eg. before extracting features for test
+data), after which unknown features are left out.
+
+Documents can be processed in parallel; each worker builds a matrix
+for its document with a vocabulary of its own, and we map those onto
+the shared vocabulary as the results come in.
+
+This module needs numpy and scipy.
+"""
+
+import bisect
+import multiprocessing
+import re
+
+import numpy
+import scipy.sparse
+
+from educe import stac
+import educe.stac.graph as stac_gr
+import educe.stac.pairs as stac_pairs
+
+UNRELATED = 'UNRELATED'
+"""
+Label for pairs of EDUs that are not related (label id 0)
+"""
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+class FeatureVocabulary:
+    """
+    Mapping from feature names to column numbers. New features are
+    added to the end as we meet them, unless the vocabulary is frozen
+    """
+    def __init__(self, names=None):
+        self.names  = []
+        self.frozen = False
+        self._ids   = {}
+        for name in names or []:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def index(self, name):
+        """
+        Column number for a feature (None if we don't know it)
+        """
+        return self._ids.get(name)
+
+    def add(self, name):
+        """
+        Column number for a feature, adding it if it is new and the
+        vocabulary is not frozen (otherwise None)
+        """
+        i = self._ids.get(name)
+        if i is None and not self.frozen:
+            i = len(self.names)
+            self._ids[name] = i
+            self.names.append(name)
+        return i
+
+    def freeze(self):
+        """
+        Stop adding features
+        """
+        self.frozen = True
+
+    def remap(self, names):
+        """
+        Numpy array of column numbers for a list of features (see `add`),
+        with -1 for any we do not know
+        """
+        ids = [ self.add(n) for n in names ]
+        return numpy.array([ -1 if i is None else i for i in ids ],
+                           dtype=numpy.int64)
+
+class FeatureMatrices:
+    """
+    Features for a batch of documents (see `edu_features` and
+    `pair_features`)
+
+    * matrix: CSR matrix, one row per instance, one column per feature
+      in the vocabulary (as it was when we built the matrix)
+    * vocabulary: the `FeatureVocabulary` for the columns
+    * rows: what each row stands for, (document key, EDU local id)
+      for EDUs, (document key, source id, target id) for pairs
+    * labels: for pairs, numpy array of label ids, one per row
+      (None for EDUs)
+    * label_vocabulary: labels for the label ids (`UNRELATED` is 0)
+    """
+    def __init__(self, matrix, vocabulary, rows,
+                 labels=None, label_vocabulary=None):
+        self.matrix           = matrix
+        self.vocabulary       = vocabulary
+        self.rows             = rows
+        self.labels           = labels
+        self.label_vocabulary = label_vocabulary
+
+class _SparseRows:
+    """
+    CSR matrix under construction, with columns numbered in the
+    order we meet the features
+    """
+    def __init__(self):
+        self.names   = []
+        self.indptr  = [0]
+        self.indices = []
+        self.data    = []
+        self._ids    = {}
+
+    def feature(self, name):
+        i = self._ids.get(name)
+        if i is None:
+            i = self._ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+    def add_row(self, features):
+        """
+        Add a row from an iterable of (column, value) pairs
+        """
+        for i, v in features:
+            self.indices.append(i)
+            self.data.append(v)
+        self.indptr.append(len(self.indices))
+
+    def to_data(self):
+        return (self.names,
+                numpy.array(self.indptr,  dtype=numpy.int64),
+                numpy.array(self.indices, dtype=numpy.int64),
+                numpy.array(self.data,    dtype=numpy.float64))
+
+# ---------------------------------------------------------------------
+# features for a single document
+# ---------------------------------------------------------------------
+
+def _words(doc, edus, tokens):
+    """
+    Lower-cased words for each EDU, from the tokens if we have
+    them (else, from the text)
+    """
+    if tokens is None:
+        return [ _WORD_RE.findall(doc.text(x.text_span()).lower())
+                 for x in edus ]
+    tokens = sorted(tokens, key=lambda t:t.text_span())
+    starts = [ t.text_span().char_start for t in tokens ]
+    res    = []
+    for x in edus:
+        sp = x.text_span()
+        i  = bisect.bisect_left(starts, sp.char_start)
+        ws = []
+        while i < len(tokens) and starts[i] < sp.char_end:
+            if sp.encloses(tokens[i].text_span()):
+                ws.append(tokens[i].word.lower())
+            i += 1
+        res.append(ws)
+    return res
+
+class _DocInfo:
+    """
+    What we need to know about the EDUs of a document to extract
+    their features
+    """
+    def __init__(self, doc, edus, twins):
+        table      = stac.turn_table(doc)
+        turns      = [ table.enclosing(x.text_span()) for x in edus ]
+        self.edus  = edus
+        self.acts  = []
+        for x in edus:
+            twin = twins.twin(x) if x.origin is not None else None
+            edu  = twin if twin is not None else x
+            self.acts.append(sorted(stac.dialogue_act(edu)))
+        self.speakers = [ t.speaker if t is not None else None
+                          for t in turns ]
+        # position of each EDU in its turn (None if not in a turn)
+        self.turn_position = []
+        self.turn_last     = []
+        counts = {}
+        for t in turns:
+            if t is None:
+                self.turn_position.append(None)
+            else:
+                self.turn_position.append(counts.get(t.turn, 0))
+                counts[t.turn] = counts.get(t.turn, 0) + 1
+        for t, p in zip(turns, self.turn_position):
+            self.turn_last.append(t is not None and p == counts[t.turn] - 1)
+
+def _edu_rows(rows, doc, info, tokens):
+    words = _words(doc, info.edus, tokens)
+    n     = len(info.edus)
+    f_turn_position = rows.feature('turn_position')
+    f_turn_first    = rows.feature('turn_first')
+    f_turn_last     = rows.feature('turn_last')
+    f_doc_position  = rows.feature('doc_position')
+    for i in range(n):
+        fs = [ (rows.feature('act=' + a), 1.0) for a in info.acts[i] ]
+        if info.speakers[i] is not None:
+            fs.append((rows.feature('speaker=' + info.speakers[i]), 1.0))
+        if info.turn_position[i] is not None:
+            fs.append((f_turn_position, float(info.turn_position[i])))
+            if info.turn_position[i] == 0:
+                fs.append((f_turn_first, 1.0))
+            if info.turn_last[i]:
+                fs.append((f_turn_last, 1.0))
+        fs.append((f_doc_position, float(i) / n))
+        fs.extend((rows.feature('word=' + w), 1.0) for w in words[i])
+        rows.add_row(fs)
+
+def _relation_labels(doc):
+    """
+    Dictionary from (source, target) local ids to relation label
+    """
+    return dict(((r.span.t1, r.span.t2), r.type) for r in doc.relations
+                if stac.is_relation_instance(r))
+
+def _pair_rows(rows, doc, info, pairs):
+    src_acts = [ [ rows.feature('src_act=' + a) for a in acts ]
+                 for acts in info.acts ]
+    tgt_acts = [ [ rows.feature('tgt_act=' + a) for a in acts ]
+                 for acts in info.acts ]
+    f_edu_dist     = rows.feature('edu_dist')
+    f_turn_dist    = rows.feature('turn_dist')
+    f_char_dist    = rows.feature('char_dist')
+    f_same_speaker = rows.feature('same_speaker')
+    f_same_turn    = rows.feature('same_turn')
+
+    same_turn = (pairs.turn_dist == 0)
+    for k, (i, j) in enumerate(zip(pairs.source, pairs.target)):
+        fs = [ (f_edu_dist,  float(pairs.edu_dist[k]))
+             , (f_turn_dist, float(pairs.turn_dist[k]))
+             , (f_char_dist, float(pairs.char_dist[k]))
+             ]
+        if info.speakers[i] is not None and\
+                info.speakers[i] == info.speakers[j]:
+            fs.append((f_same_speaker, 1.0))
+        if same_turn[k]:
+            fs.append((f_same_turn, 1.0))
+        fs.extend((f, 1.0) for f in src_acts[i])
+        fs.extend((f, 1.0) for f in tgt_acts[j])
+        fs.extend((rows.feature('acts=%s>%s' % (a, b)), 1.0)
+                  for a in info.acts[i] for b in info.acts[j])
+        rows.add_row(fs)
+
+def _doc_features(corpus, key, twins, kind, options):
+    """
+    Features for one document, with a vocabulary of its own:
+    (feature names, indptr, indices, data, row ids, labels)
+    """
+    doc    = corpus[key]
+    rows   = _SparseRows()
+    tokens = options.get('tokens')
+    tokens = tokens.get(key) if tokens is not None else None
+    if kind == 'edu':
+        edus = sorted(filter(stac.is_edu, doc.units), key=lambda x:x.span)
+        info = _DocInfo(doc, edus, twins)
+        _edu_rows(rows, doc, info, tokens)
+        row_ids = [ (key, x.local_id()) for x in edus ]
+        labels  = None
+    else:
+        pair_args = dict(options.get('pair_args', {}))
+        if pair_args.pop('with_graph', False):
+            pair_args['graph'] = stac_gr.Graph.from_doc(corpus, key)
+        pairs = stac_pairs.candidate_pairs(doc, **pair_args)
+        info  = _DocInfo(doc, pairs.edus, twins)
+        _pair_rows(rows, doc, info, pairs)
+        ids   = [ x.local_id() for x in pairs.edus ]
+        row_ids = [ (key, ids[i], ids[j])
+                    for i, j in zip(pairs.source, pairs.target) ]
+        rels    = _relation_labels(doc)
+        labels  = [ rels.get((ids[i], ids[j]))
+                    for i, j in zip(pairs.source, pairs.target) ]
+    return rows.to_data() + (row_ids, labels)
+
+# worker process state for _extract
+_extractor_args = None
+
+def _init_extractor(corpus, kind, options):
+    global _extractor_args
+    _extractor_args = (corpus, stac.TwinIndex(corpus), kind, options)
+
+def _extract_doc(key):
+    corpus, twins, kind, options = _extractor_args
+    return _doc_features(corpus, key, twins, kind, options)
+
+# ---------------------------------------------------------------------
+# putting it together
+# ---------------------------------------------------------------------
+
+def _extract(corpus, keys, kind, options, vocabulary, label_vocabulary, jobs):
+    keys = sorted(corpus.keys() if keys is None else keys)
+    if vocabulary is None:
+        vocabulary = FeatureVocabulary()
+    if kind == 'pair' and label_vocabulary is None:
+        label_vocabulary = FeatureVocabulary([UNRELATED])
+
+    if jobs > 1 and len(keys) > 1:
+        pool    = multiprocessing.Pool(processes=jobs,
+                                       initializer=_init_extractor,
+                                       initargs=(corpus, kind, options))
+        results = pool.imap(_extract_doc, keys)
+    else:
+        pool    = None
+        twins   = stac.TwinIndex(corpus)
+        results = (_doc_features(corpus, k, twins, kind, options)
+                   for k in keys)
+
+    all_indptr  = [ numpy.zeros(1, dtype=numpy.int64) ]
+    all_indices = []
+    all_data    = []
+    all_rows    = []
+    all_labels  = []
+    offset      = 0
+    try:
+        for names, indptr, indices, data, row_ids, labels in results:
+            # local feature numbers to vocabulary columns, dropping
+            # the features a frozen vocabulary does not know
+            columns = vocabulary.remap(names)[indices]
+            keep    = columns >= 0
+            row_of  = numpy.repeat(numpy.arange(len(row_ids)),
+                                   numpy.diff(indptr))
+            counts  = numpy.bincount(row_of[keep], minlength=len(row_ids))
+            all_indptr.append(offset + numpy.cumsum(counts))
+            all_indices.append(columns[keep])
+            all_data.append(data[keep])
+            offset += int(keep.sum())
+            all_rows.extend(row_ids)
+            if labels is not None:
+                all_labels.extend(label_vocabulary.add(l or UNRELATED)
+                                  for l in labels)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def concat(arrays, dtype):
+        if arrays:
+            return numpy.concatenate(arrays).astype(dtype)
+        return numpy.zeros(0, dtype=dtype)
+
+    matrix = scipy.sparse.csr_matrix(
+        (concat(all_data, numpy.float64),
+         concat(all_indices, numpy.int32),
+         concat(all_indptr, numpy.int32)),
+        shape=(len(all_rows), len(vocabulary)))
+    matrix.sum_duplicates()
+    if kind == 'pair':
+        # unknown labels (frozen label vocabulary) count as unrelated
+        labels = numpy.array([ 0 if l is None else l for l in all_labels ],
+                             dtype=numpy.int32)
+    else:
+        labels = None
+    return FeatureMatrices(matrix, vocabulary, all_rows,
+                           labels=labels, label_vocabulary=label_vocabulary)
+
+def edu_features(corpus, keys=None, vocabulary=None, tokens=None, jobs=1):
+    """
+    Return `FeatureMatrices` for the EDUs in the given documents
+    (default: all of them), one row per EDU, documents in key order
+    and EDUs in textual order
+
+    :param vocabulary: feature columns (new features are added to it
+        unless it is frozen); default: a fresh one
+    :type  vocabulary: `FeatureVocabulary`
+
+    :param tokens: tokens for each document (eg. from
+        `educe.stac.postag.read_tags`); if not given, we split the
+        EDU text into words
+    :type  tokens: dict from `FileId` to list of tokens
+
+    :param jobs: number of worker processes
+    :type  jobs: int
+    """
+    options = { 'tokens' : tokens }
+    return _extract(corpus, keys, 'edu', options, vocabulary, None, jobs)
+
+def pair_features(corpus, keys=None, vocabulary=None, label_vocabulary=None,
+                  jobs=1, **kwargs):
+    """
+    Return `FeatureMatrices` for candidate EDU pairs in the given
+    documents (default: all of them), one row per pair. Candidate
+    pairs are as in `educe.stac.pairs.corpus_pairs`, to which any
+    other keyword arguments are passed (eg. `window`, `with_graph`).
+
+    The labels are those of the relation instances from the first
+    EDU in each pair to the second, if any (if you want relations in
+    either direction, ask for `directed` pairs)
+
+    :param label_vocabulary: label ids (new labels are added to it
+        unless it is frozen); default: a fresh one
+    :type  label_vocabulary: `FeatureVocabulary`
+    """
+    options = { 'pair_args' : kwargs }
+    return _extract(corpus, keys, 'pair', options,
+                    vocabulary, label_vocabulary, jobs)
@@ -27,6 +27,27 @@ class MultiheadedCduException(Exception):
         self.cdu = cdu
         Exception.__init__(self, *args, **kw)
 
+class CduHeadInfo(object):
+    """
+    What we know about the head of a CDU (see `Graph.cdu_heads_report`)
+
+    * cdu: the CDU hyperedge
+    * candidates: members of the CDU that no other member points to,
+      textually leftmost first (CDUs are given as hyperedges)
+    * head: the first candidate (None if there are no candidates)
+    * multiheaded: True if there is more than one candidate
+    * deep_head: the head, or if that is a CDU, its deep head
+      (None if we do not reach a DU that is not a CDU)
+    * depth: number of CDUs this one is nested in
+    """
+    def __init__(self, cdu, candidates, depth, deep_head=None):
+        self.cdu         = cdu
+        self.candidates  = candidates
+        self.head        = candidates[0] if candidates else None
+        self.multiheaded = len(candidates) > 1
+        self.deep_head   = deep_head
+        self.depth       = depth
+
 class Graph(educe.graph.Graph):
     def __init__(self):
         return educe.graph.Graph.__init__(self)
@@ -76,95 +97,150 @@ class Graph(educe.graph.Graph):
         else:
             hyperedge = cdu
 
-        members    = self.cdu_members(cdu)
-        candidates = []
-        for m in members:
-            def points_to_me(l): # some other member of this CDU
-                                 # points to me via this link
-                return l != hyperedge\
-                        and self.is_relation(l)\
-                        and self.links(l)[1] == m\
-                        and self.links(l)[0] in members
-            pointed_to = filter(points_to_me, self.links(m))
-            if not (self.is_relation(m) or pointed_to):
-                candidates.append(m)
-
-        if len(candidates) == 0:
-            return None
-        elif len(candidates) == 1 or sloppy:
-            c = self.sorted_first_widest(candidates)[0]
-            if self.is_cdu(c):
-                return self.mirror(c)
-            else:
-                return c
-        else:
+        info = self.cdu_heads_report()[hyperedge]
+        if info.multiheaded and not sloppy:
             raise MultiheadedCduException(cdu)
+        return info.head
 
     def recursive_cdu_heads(self, sloppy=False):
         """
         A dictionary mapping each CDU to its recursive CDU
         head (see `cdu_head`)
         """
-        cache = {}
-        def get_head(c):
-            if c in cache:
-                return cache[c]
-            else:
-                hd = self.cdu_head(c, sloppy)
-                if hd is None: return None
-                if self.is_cdu(hd):
-                    deep_hd = get_head(hd)
-                else:
-                    deep_hd = hd
-                if deep_hd is None:
-                    return None
-                else:
-                    cache[c] = deep_hd
-                    return deep_hd
+        report = self.cdu_heads_report()
+        if not sloppy:
+            for c, info in report.items():
+                if info.multiheaded:
+                    raise MultiheadedCduException(c)
+        return dict((c, info.deep_head) for c, info in report.items()
+                    if info.deep_head is not None)
+
+    def cdu_heads_report(self):
+        """
+        A dictionary from each CDU (hyperedge) to a `CduHeadInfo`
+        with its head, alternative heads (if the CDU is multiheaded),
+        recursive head, and depth.
+
+        This is computed for all CDUs at once, and remembered until
+        the graph changes
+        """
+        if getattr(self, '_cdu_heads', None) is not None:
+            return self._cdu_heads
+
+        # relation instances pointing to each node (with their source)
+        incoming = collections.defaultdict(list)
+        for r in self.relations():
+            links = self.links(r)
+            if len(links) == 2:
+                incoming[links[1]].append((r, links[0]))
+
+        report = {}
         for c in self.cdus():
-            get_head(c)
-        return cache
+            members = self.cdu_members(c)
+            def is_candidate(m):
+                return not self.is_relation(m) and\
+                        not any(r != c and src in members
+                                for r, src in incoming[m])
+            candidates = self.sorted_first_widest(filter(is_candidate,
+                                                         members))
+            candidates = [ self.mirror(m) if self.is_cdu(m) else m
+                           for m in candidates ]
+            report[c] = CduHeadInfo(cdu=c,
+                                    candidates=candidates,
+                                    depth=self.cdu_depth(c))
+
+        # recursive heads (guarding against CDUs that contain each other)
+        for c, info in report.items():
+            seen = set()
+            head = info.head
+            while head in report and head not in seen:
+                seen.add(head)
+                if report[head].deep_head is not None:
+                    head = report[head].deep_head
+                    break
+                head = report[head].head
+            if head in report: # cycle or headless CDU
+                head = None
+            info.deep_head = head
+
+        self._cdu_heads = report
+        return report
+
+    def _invalidate_indexes(self):
+        super(Graph, self)._invalidate_indexes()
+        self._cdu_heads          = None
+        self._first_widest       = None
+        self._first_widest_keys  = None
 
     def without_cdus(self, sloppy=False):
         """
-        Return a deep copy of this graph with all CDUs removed.
+        Return a copy of this graph with all CDUs removed.
         Links involving these CDUs will point instead from/to
-        their deep heads
+        their deep heads.
+
+        Neither this graph nor its document are modified. The copy
+        shares its nodes and annotations with this graph, except for
+        the relation instances that have to be redirected: these are
+        replaced by shallow copies pointing to the heads. The copy's
+        `doc` (and `corpus`) is likewise a shallow copy of the
+        original, with the CDUs left out and the redirected relations
+        swapped in
         """
-        g2    = copy.deepcopy(self)
-        heads = g2.recursive_cdu_heads(sloppy)
-        anno_heads = dict((g2.annotation(k),g2.annotation(v))\
+        heads = self.recursive_cdu_heads(sloppy)
+        anno_heads = dict((self.annotation(k),self.annotation(v))\
                           for k,v in heads.items())
-        # replace all links to/from cdus with to/from their heads
-        for e_edge in g2.relations():
-            links  = g2.links(e_edge)
-            attrs  = g2.edge_attributes(e_edge)
-            if any(g2.is_cdu(l) for l in links):
-                # recreate the edge
-                g2.del_edge(e_edge)
-                g2.add_edge(e_edge)
-                g2.add_edge_attributes(e_edge, attrs)
-                for l in links:
-                    l2 = heads[g2.mirror(l)] if g2.is_cdu(l) else l
-                    g2.link(l2, e_edge)
-        # now that we've pointed everything away, nuke the CDUs
-        for e_cdu in g2.cdus():
-            g2.del_node(g2.mirror(e_cdu))
-            g2.del_edge(e_cdu)
-        # to be on the safe side, we should also do similar link-rewriting
-        # but on the underlying educe.annotation objects layer
-        # (symptom of a yucky design) :-(
-        for r in g2.doc.relations:
-            if stac.is_relation_instance(r):
-                src  = r.source
-                tgt  = r.target
-                src2 = anno_heads.get(src, src)
-                tgt2 = anno_heads.get(tgt, tgt)
-                r.source = src2
-                r.target = tgt2
-                r.span   = annotation.RelSpan(src2.local_id(), tgt2.local_id())
-        # remove the actual CDU objects too
-        g2.doc.schemas = [ s for s in g2.doc.schemas if not stac.is_cdu(s) ]
+
+        # redirect relation instances on the annotation layer
+        # (leaving the original annotations alone)
+        rels = filter(stac.is_relation_instance, self.doc.relations)
+        def is_moved(r):
+            return r.source in anno_heads or r.target in anno_heads
+        retargeted = dict((r, copy.copy(r)) for r in rels if is_moved(r))
+        # relations that point to redirected relations must point to
+        # their copies instead (and so be copied themselves)
+        grown = True
+        while grown:
+            grown = False
+            for r in rels:
+                if r not in retargeted and\
+                        (r.source in retargeted or r.target in retargeted):
+                    retargeted[r] = copy.copy(r)
+                    grown = True
+        for r, r2 in retargeted.items():
+            src2      = anno_heads.get(r.source, r.source)
+            tgt2      = anno_heads.get(r.target, r.target)
+            r2.source = retargeted.get(src2, src2)
+            r2.target = retargeted.get(tgt2, tgt2)
+            r2.span   = annotation.RelSpan(src2.local_id(), tgt2.local_id())
+
+        doc2           = copy.copy(self.doc)
+        doc2.relations = [ retargeted.get(r, r) for r in self.doc.relations ]
+        doc2.rels      = doc2.relations
+        doc2.schemas   = [ s for s in self.doc.schemas if not stac.is_cdu(s) ]
+        corpus2        = dict(self.corpus)
+        corpus2[self.doc_key] = doc2
+
+        def attrs2(attrs):
+            return [ (k, retargeted.get(v, v) if k == 'annotation' else v)
+                     for k, v in attrs ]
+
+        g2 = self._empty_copy()
+        g2.corpus = corpus2
+        g2.doc    = doc2
+        for n in self.nodes():
+            if not self.is_cdu(n):
+                g2.add_node(n)
+                for kv in attrs2(self.node_attributes(n)):
+                    g2.add_node_attribute(n, kv)
+        for e in self.hyperedges():
+            if self.is_cdu(e):
+                continue
+            g2.add_hyperedge(e)
+            for kv in attrs2(self.edge_attributes(e)):
+                g2.add_edge_attribute(e, kv)
+            for l in self.links(e):
+                l2 = heads[self.mirror(l)] if self.is_cdu(l) else l
+                g2.link(l2, e)
         return g2
 
     # --------------------------------------------------
@@ -176,29 +252,52 @@ class Graph(educe.graph.Graph):
         Given a list of nodes, return the nodes ordered by their starting point,
         and in case of a tie their inverse width (ie. widest first).
         """
-        def span(n):
-            return self.annotation(n).text_span()
+        return sorted(xs, key=self._first_widest_key)
 
-        def from_span(sp):
+    def _first_widest_key(self, n):
+        """
+        Sort key for `sorted_first_widest` (ties are broken on the
+        node name). Text spans are remembered until the graph changes
+        """
+        keys = self._first_widest_keys
+        if keys is None:
+            keys = self._first_widest_keys = {}
+        if n not in keys:
+            sp = self.annotation(n).text_span()
             # negate the endpoint so that if we have a tie on the starting
             # point, the widest span comes first
-            return (sp.char_start, 0 - sp.char_end)
-
-        tagged = sorted((from_span(span(x)),x) for x in xs)
-        return [x for _,x in tagged]
+            keys[n] = (sp.char_start, 0 - sp.char_end)
+        return (keys[n], n)
 
     def first_widest_dus(self):
         """
         Return discourse units in this graph, ordered by their starting point,
         and in case of a tie their inverse width (ie. widest first)
         """
-        def is_interesting_du(n):
-            return self.is_edu(n) or\
-                (self.is_cdu(n) and self.cdu_members(n))
+        return list(self._first_widest_order()[0])
+
+    def first_widest_rank(self):
+        """
+        Dictionary from each discourse unit to its position in
+        `first_widest_dus`
+        """
+        return self._first_widest_order()[1]
 
-        dus = filter(is_interesting_du,self.nodes())
-        return self.sorted_first_widest(dus)
+    def _first_widest_order(self):
+        """
+        The `first_widest_dus` ordering and its rank map, computed
+        once and remembered until the graph changes
+        """
+        if self._first_widest is None:
+            def is_interesting_du(n):
+                return self.is_edu(n) or\
+                    (self.is_cdu(n) and self.cdu_members(n))
 
+            dus  = self.sorted_first_widest(filter(is_interesting_du,
+                                                   self.nodes()))
+            rank = dict((n, i) for i, n in enumerate(dus))
+            self._first_widest = (dus, rank)
+        return self._first_widest
 
     def _build_right_frontier(self, points, last):
         """
@@ -230,12 +329,8 @@ class Graph(educe.graph.Graph):
         * points to it with a subordinating relation
         * includes it as a CDU member
         """
-        points = {}
-        def position(n):
-            if n in nodes:
-                return nodes.index(n)
-            else:
-                return -1
+        points   = {}
+        position = dict((n, i) for i, n in enumerate(nodes))
 
         for n1 in nodes:
             candidates = []
@@ -247,7 +342,7 @@ class Graph(educe.graph.Graph):
                         and len(ns) == 2 and ns[1] == n1
 
             def add_candidate(n2):
-                candidates.append((n2,position(n2)))
+                candidates.append((n2,position.get(n2, -1)))
 
             for l in self.links(n1):
                 if is_incoming_subordinate_rel(l):
@@ -265,13 +360,22 @@ class Graph(educe.graph.Graph):
 
         return points
 
+    def frontier_index(self, nodes=None):
+        """
+        Return a `FrontierIndex` for the given ordered sequence of
+        nodes (by default, `first_widest_dus`)
+        """
+        if nodes is None:
+            nodes = self._first_widest_order()[0]
+        return FrontierIndex(self._frontier_points(nodes))
+
     def right_frontier_violations(self):
-        nodes      = self.first_widest_dus()
+        nodes      = self._first_widest_order()[0]
         violations = collections.defaultdict(list)
         if len(nodes) < 2:
             return violations
 
-        points = self._frontier_points(nodes)
+        frontier = self.frontier_index(nodes)
         nexts  = itertools.islice(nodes, 1, None)
         for last,n1 in itertools.izip(nodes, nexts):
             def is_incoming(l):
@@ -281,10 +385,197 @@ class Graph(educe.graph.Graph):
             for l in self.links(n1):
                 if not is_incoming(l): continue
                 n2 = self.links(l)[0]
-                if not self._is_on_right_frontier(points, last, n2):
+                if not frontier.is_on_frontier(last, n2):
                     violations[n2].append(l)
         return violations
 
+class FrontierIndex(object):
+    """
+    The right frontiers of all the discourse units in a graph.
+
+    The frontier points (see `Graph._frontier_points`) map each node
+    to its nearest dominating node, so they form a forest; the right
+    frontier of a node is its path to the root of its tree.  We number
+    the nodes in a depth-first traversal of the forest, noting when we
+    enter and leave each one, so that whether a node is on another's
+    right frontier (ie. is its ancestor) is just a matter of comparing
+    numbers.
+
+    Nodes which do not make it into the forest (because the points
+    form a cycle) fall back to walking up the frontier
+    """
+    def __init__(self, points):
+        self.points = points
+        self.tin    = {}
+        self.tout   = {}
+
+        children = collections.defaultdict(list)
+        roots    = []
+        for n, p in points.items():
+            if p is None or p == n or p not in points:
+                roots.append(n)
+            else:
+                children[p].append(n)
+
+        clock = 0
+        for root in roots:
+            self.tin[root] = clock
+            clock += 1
+            stack = [(root, iter(children[root]))]
+            while stack:
+                node, kids = stack[-1]
+                kid = next(kids, None)
+                if kid is None:
+                    self.tout[node] = clock
+                    clock += 1
+                    stack.pop()
+                else:
+                    self.tin[kid] = clock
+                    clock += 1
+                    stack.append((kid, iter(children[kid])))
+
+    def is_on_frontier(self, last, node):
+        """
+        True if `node` is on the right frontier of `last`
+        """
+        if last in self.tin:
+            return node in self.tin and\
+                    self.tin[node] <= self.tin[last] and\
+                    self.tout[last] <= self.tout[node]
+        # cycle: walk (carefully)
+        seen    = set()
+        current = last
+        while current in self.points and current not in seen:
+            if current == node:
+                return True
+            seen.add(current)
+            current = self.points[current]
+        return False
+
+    def frontier(self, last):
+        """
+        The right frontier of `last` (starting from `last`)
+        """
+        seen    = set()
+        current = last
+        while current in self.points and current not in seen:
+            yield current
+            seen.add(current)
+            current = self.points[current]
+
+class IncrementalRightFrontier(object):
+    """
+    The right frontier of a dialogue that is still being built, for
+    example by a parser which reads one EDU at a time and must decide
+    what it can attach to.
+
+    Discourse units are identified by whatever (hashable) ids you like.
+    We follow the same conventions as `Graph._frontier_points`: a unit
+    is dominated by the nearest (in first-widest order) unit which
+    either points to it with a subordinating relation or is a CDU it
+    belongs to, and the right frontier is the path of dominating units
+    up from the last EDU.
+
+    Relations are subordinating if their label is one of
+    `stac.subordinating_relations` (as for `stac.is_subordinating`).
+
+    Note that `frontier` starts from the last EDU, so once you have
+    pushed a new EDU, it is the only thing on the frontier until you
+    attach something to it. To see what the new EDU could attach to,
+    either ask before pushing it, or use `previous_frontier`.
+
+    Adding EDUs, relations and CDUs takes constant time (more or less:
+    CDUs are proportional to their size); the frontier is computed on
+    demand in time proportional to its length, and remembered until
+    the next change
+    """
+    def __init__(self):
+        self._extent   = {}   # unit -> (first EDU number, last EDU number)
+        self._points   = {}   # unit -> nearest dominating unit
+        self._last     = None
+        self._previous = None # EDU before the last one
+        self._frontier = None # cached
+
+    def _order(self, unit):
+        # first-widest order, as in `Graph.sorted_first_widest`
+        first, last = self._extent[unit]
+        return (first, 0 - last)
+
+    def _add_point(self, unit, dominator):
+        current = self._points.get(unit)
+        if current is None or\
+                self._order(dominator) >= self._order(current):
+            self._points[unit] = dominator
+        self._frontier = None
+
+    def push_edu(self, edu):
+        """
+        Add an EDU to the end of the dialogue
+        """
+        n = len(self._extent)
+        self._extent[edu] = (n, n)
+        self._previous    = self._last
+        self._last        = edu
+        self._frontier    = None
+
+    def attach(self, src, tgt, label):
+        """
+        Note a relation instance from `src` to `tgt` (both of which
+        we should already know about)
+        """
+        if label in stac.subordinating_relations:
+            self._add_point(tgt, src)
+
+    def add_cdu(self, cdu, members):
+        """
+        Note a CDU, grouping some EDUs and/or CDUs we already know about
+        """
+        extents = [ self._extent[m] for m in members ]
+        self._extent[cdu] = (min(e[0] for e in extents),
+                             max(e[1] for e in extents))
+        for m in members:
+            self._add_point(m, cdu)
+
+    def _walk(self, start):
+        frontier = []
+        seen     = set()
+        current  = start
+        while current is not None and current not in seen:
+            frontier.append(current)
+            seen.add(current)
+            current = self._points.get(current)
+        return frontier, seen
+
+    def frontier(self):
+        """
+        The units on the right frontier, starting from the last EDU
+        """
+        if self._frontier is None:
+            self._frontier = self._walk(self._last)
+        return list(self._frontier[0])
+
+    def previous_frontier(self):
+        """
+        The units on the right frontier starting from the EDU before
+        the last one, ie. the units the last EDU could attach to
+        (as in `educe.stac.pairs.candidate_pairs`)
+        """
+        return self._walk(self._previous)[0]
+
+    def on_frontier(self, unit):
+        """
+        True if a new EDU could attach to this unit
+        """
+        if self._frontier is None:
+            self.frontier()
+        return unit in self._frontier[1]
+
+class IndexedGraph(Graph, educe.graph.IndexedHypergraph):
+    """
+    STAC `Graph` on the `educe.graph.IndexedHypergraph` backend
+    """
+    pass
+
 class DotGraph(educe.graph.DotGraph):
     """
     A dot representation of this graph for visualisation.
@@ -293,20 +584,18 @@ class DotGraph(educe.graph.DotGraph):
 
     def __init__(self, anno_graph):
         doc   = anno_graph.doc
-        nodes = anno_graph.first_widest_dus()
+        rank  = anno_graph.first_widest_rank()
         self.node_order = {}
-        for i,n in enumerate(nodes):
+        for n,i in rank.items():
             self.node_order[anno_graph.annotation(n)] = i
+        self.twins = stac.TwinIndex(anno_graph.corpus)
+        self.turns = stac.turn_table(doc)
         educe.graph.DotGraph.__init__(self, anno_graph)
 
     def _get_turn_info(self, u):
-        enclosing_turns = [ t for t in self.turns if t.span.encloses(u.span) ]
-        if len(enclosing_turns) > 0:
-            turn      = enclosing_turns[0]
-            speaker   = turn.features['Emitter']
-            turn_text = stac.split_turn_text(self.doc.text(turn.span))[0]
-            turn_id   = turn_text.split(':')[0].strip()
-            return speaker, turn_id
+        turn = self.turns.enclosing(u.span)
+        if turn is not None:
+            return turn.speaker, turn.identifier
         else:
             return None, None
 
@@ -314,7 +603,7 @@ class DotGraph(educe.graph.DotGraph):
         # In discourse annotated part of the corpus, all segments have
         # type 'Other', which isn't too helpful. Try to recover the
         # speech act from the unit equivalent to this document
-        twin = stac.twin(self.corpus, anno)
+        twin = self.twins.twin(anno)
         edu  = twin if twin is not None else anno
         return stac.dialogue_act(edu)
 
@@ -322,7 +611,7 @@ class DotGraph(educe.graph.DotGraph):
         # In discourse annotated part of the corpus, all segments have
         # type 'Other', which isn't too helpful. Try to recover the
         # speech act from the unit equivalent to this document
-        twin = stac.twin(self.corpus, anno)
+        twin = self.twins.twin(anno)
         edu  = twin if twin is not None else anno
         return edu.features.get('Addressee', None)
 
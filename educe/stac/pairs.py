@@ -0,0 +1,222 @@
+# Author: Eric Kow
+# License: BSD3
+
+"""
+Candidate EDU pairs for attachment models.
+
+For each document (see `corpus_pairs`) we consider the EDUs in
+textual order, and generate the pairs of EDUs that are in the same
+dialogue, optionally limited to
+
+* pairs no more than so many EDUs apart (`window`)
+* pairs of EDUs from the same speaker or from different speakers
+  (`same_speaker`); EDUs whose speaker we do not know are left out
+  either way
+* pairs whose earlier EDU is on the right frontier of the EDU just
+  before the later one, according to a discourse graph (`graph`)
+
+The pairs come as numpy arrays of indices into the document's list
+of EDUs, along with the distance between the EDUs in each pair in
+EDUs, turns and characters. They are generated a dialogue at a time
+with array operations rather than loops over pairs.
+
+This module needs numpy.
+"""
+
+import collections
+
+import numpy
+
+from educe import stac
+import educe.stac.graph as stac_gr
+
+class EduPairs:
+    """
+    Candidate pairs of EDUs in a document
+
+    * edus: the EDU annotations, in textual order
+    * source, target: for each pair, indices into `edus`
+    * edu_dist: number of EDUs from source to target (negative if
+      the target comes first)
+    * turn_dist: number of turns from source to target (meaningless
+      if either EDU is outside of any turn)
+    * char_dist: number of characters between the starting points
+      of the source and the target
+
+    All but `edus` are numpy arrays of the same length
+    """
+    def __init__(self, edus, source, target, edu_dist, turn_dist, char_dist):
+        self.edus      = edus
+        self.source    = source
+        self.target    = target
+        self.edu_dist  = edu_dist
+        self.turn_dist = turn_dist
+        self.char_dist = char_dist
+
+    def __len__(self):
+        return len(self.source)
+
+    def __iter__(self):
+        """
+        The pairs as (source, target) annotation tuples
+        """
+        for i, j in zip(self.source, self.target):
+            yield self.edus[i], self.edus[j]
+
+def _enclosing(spans, edu_spans):
+    """
+    For each EDU span, the index of the first span in (sorted,
+    non-overlapping) `spans` that encloses it, or -1
+    """
+    starts = numpy.array([ sp.char_start for sp in spans ], dtype=numpy.int64)
+    ends   = numpy.array([ sp.char_end   for sp in spans ], dtype=numpy.int64)
+    estart = numpy.array([ sp.char_start for sp in edu_spans ],
+                         dtype=numpy.int64)
+    eend   = numpy.array([ sp.char_end   for sp in edu_spans ],
+                         dtype=numpy.int64)
+    if not len(starts):
+        return numpy.zeros(len(estart), dtype=numpy.int32) - 1
+    idx = numpy.searchsorted(starts, estart, side='right') - 1
+    ok  = (idx >= 0) & (eend <= ends[numpy.maximum(idx, 0)])
+    return numpy.where(ok, idx, -1).astype(numpy.int32)
+
+def _block_pairs(size, window):
+    """
+    Pairs of indices (i < j) in a block of this many EDUs,
+    at most `window` apart (if given)
+    """
+    if window is None or window >= size - 1:
+        return numpy.triu_indices(size, 1)
+    sources = []
+    targets = []
+    for d in range(1, window + 1):
+        i = numpy.arange(size - d)
+        sources.append(i)
+        targets.append(i + d)
+    return numpy.concatenate(sources), numpy.concatenate(targets)
+
+def _frontier_mask(graph, edus, source, target):
+    """
+    Which of the pairs (source < target) have their source on the
+    right frontier of the EDU just before the target.
+
+    Note that this is the previous EDU in textual order, not the
+    previous discourse unit: if that EDU is in a CDU, the frontier
+    goes up through the CDU from the EDU rather than starting from
+    the CDU itself
+    """
+    index = graph.frontier_index()
+    nodes  = dict((graph.annotation(n), n) for n in graph.edus())
+    enodes = [ nodes.get(x) for x in edus ]
+    tin    = numpy.array([ index.tin.get(n, -1)  for n in enodes ],
+                         dtype=numpy.int64)
+    tout   = numpy.array([ index.tout.get(n, -1) for n in enodes ],
+                         dtype=numpy.int64)
+    last   = target - 1
+    mask   = (tin[source] >= 0) & (tin[last] >= 0) &\
+             (tin[source] <= tin[last]) & (tout[last] <= tout[source])
+    # nodes caught up in cycles are not numbered; ask the index.
+    # EDUs that are not related to anything are not in the graph
+    # at all, and are on nobody's frontier but their own
+    for k in numpy.flatnonzero((tin[source] < 0) | (tin[last] < 0)):
+        n_last = enodes[last[k]]
+        n_src  = enodes[source[k]]
+        if n_last is not None and n_src is not None:
+            mask[k] = index.is_on_frontier(n_last, n_src)
+        else:
+            mask[k] = source[k] == last[k]
+    return mask
+
+def candidate_pairs(doc, window=None, same_speaker=None, directed=False,
+                    graph=None):
+    """
+    Return the `EduPairs` for a document
+
+    :param window: only pair EDUs that are at most this many EDUs
+        apart (default: no limit)
+    :type  window: int
+
+    :param same_speaker: if True, only pair EDUs from the same speaker,
+        if False, only EDUs from different speakers (default: either).
+        If set either way, EDUs outside of any turn or in turns with
+        no known speaker are never paired
+
+    :param directed: include both (a, b) and (b, a) for each pair
+        instead of just the pair where a comes first
+
+    :param graph: discourse graph for the document; if given, only
+        keep pairs whose earlier EDU is on the right frontier of the
+        EDU just before the later one (the previous EDU, not the
+        previous discourse unit; see `educe.stac.graph.FrontierIndex`)
+    :type  graph: `educe.stac.graph.Graph`
+    """
+    edus      = sorted(filter(stac.is_edu, doc.units), key=lambda x:x.span)
+    edu_spans = [ x.text_span() for x in edus ]
+    starts    = numpy.array([ sp.char_start for sp in edu_spans ],
+                            dtype=numpy.int64)
+
+    turns      = stac.turn_table(doc).infos
+    turn_idx   = _enclosing([ t.turn.text_span() for t in turns ], edu_spans)
+    dialogues  = sorted(filter(lambda x:x.type == 'Dialogue', doc.units),
+                        key=lambda x:x.span)
+    dialogue_idx = _enclosing([ x.text_span() for x in dialogues ], edu_spans)
+
+    speaker_ids = collections.defaultdict(lambda:len(speaker_ids))
+    def speaker(t):
+        if t < 0 or turns[t].speaker is None:
+            return -1
+        return speaker_ids[turns[t].speaker]
+    speakers    = numpy.array(map(speaker, turn_idx), dtype=numpy.int32)
+
+    # runs of consecutive EDUs in the same dialogue
+    sources = []
+    targets = []
+    breaks  = numpy.flatnonzero(numpy.diff(dialogue_idx)) + 1
+    bounds  = [0] + list(breaks) + [len(edus)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if end - start < 2:
+            continue
+        i, j = _block_pairs(end - start, window)
+        sources.append(i + start)
+        targets.append(j + start)
+    if sources:
+        source = numpy.concatenate(sources).astype(numpy.int32)
+        target = numpy.concatenate(targets).astype(numpy.int32)
+    else:
+        source = numpy.zeros(0, dtype=numpy.int32)
+        target = numpy.zeros(0, dtype=numpy.int32)
+
+    if same_speaker is not None:
+        known = (speakers[source] >= 0) & (speakers[target] >= 0)
+        same  = speakers[source] == speakers[target]
+        keep  = known & (same if same_speaker else ~same)
+        source, target = source[keep], target[keep]
+    if graph is not None and len(source):
+        keep = _frontier_mask(graph, edus, source, target)
+        source, target = source[keep], target[keep]
+    if directed:
+        source, target = numpy.concatenate([source, target]),\
+                         numpy.concatenate([target, source])
+
+    return EduPairs(edus=edus,
+                    source=source,
+                    target=target,
+                    edu_dist=target - source,
+                    turn_dist=turn_idx[target] - turn_idx[source],
+                    char_dist=starts[target] - starts[source])
+
+def corpus_pairs(corpus, keys=None, with_graph=False, **kwargs):
+    """
+    Generate (key, `EduPairs`) for each document in the corpus, one
+    document at a time (so only one document's worth of pairs need
+    be in memory at once).
+
+    If `with_graph` is True, we build a discourse graph for each
+    document and use it to filter the pairs on the right frontier
+    (see `candidate_pairs`). Other keyword arguments are passed on
+    to `candidate_pairs`
+    """
+    for k in sorted(keys if keys is not None else corpus):
+        doc   = corpus[k]
+        graph = stac_gr.Graph.from_doc(corpus, k) if with_graph else None
+        yield k, candidate_pairs(doc, graph=graph, **kwargs)
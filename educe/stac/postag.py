@@ -37,10 +37,9 @@ def extract_turns(doc):
     Return a string representation of the document's turn text
     for use by a tagger
     """
-    turns = sorted_by_span(filter(stac.is_turn, doc.units))
-    def ttext(turn):
-        return stac.split_turn_text(doc.text_for(turn))[1]
-    return "\n".join(map(ttext, turns))
+    def ttext(info):
+        return doc.text(info.body_span)
+    return "\n".join(map(ttext, stac.turn_table(doc)))
 
 def tagger_cmd(tagger_jar, txt_file):
     return [ 'java'
@@ -91,14 +90,14 @@ def read_tags(corpus, dir):
     pos_tags = {}
     for k in corpus:
         doc   = corpus[k]
-        turns = sorted_by_span(filter(stac.is_turn, doc.units))
+        turns = stac.turn_table(doc)
 
         tagged_file = tagger_file_name(k, dir)
         raw_toks    = ext.read_token_file(tagged_file)
         pos_tags[k] = []
         for turn, seg in zip(turns, raw_toks):
-            prefix, body = stac.split_turn_text(doc.text_for(turn))
-            start        = turn.span.char_start + len(prefix)
+            body         = doc.text(turn.body_span)
+            start        = turn.body_span.char_start
             toks = ext.token_spans(body, seg, start)
             for t in toks:
                 t.origin = doc
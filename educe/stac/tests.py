@@ -8,7 +8,10 @@ Tests for educe.stac
 """
 
 import copy
+import shutil
+import tempfile
 
+import educe.graph
 import educe.tests
 import educe.stac.graph as stac_gr
 from educe import annotation, corpus, stac
@@ -93,11 +96,13 @@ def nodeform_graph_ids(gr):
     return ids
 
 class GraphTest(unittest.TestCase):
+    graph_class = stac_gr.Graph
+
     def mk_graph(self, edus, rels, cdus):
         doc  = FakeDocument(edus,rels,cdus)
         k    = FakeKey('k')
         doc.fleshout(k)
-        gr   = stac_gr.Graph.from_doc({k:doc}, k)
+        gr   = self.graph_class.from_doc({k:doc}, k)
         return gr, graph_ids(gr)
 
     def setUp(self):
@@ -134,6 +139,160 @@ class GraphTest(unittest.TestCase):
         expected = None
         self.assertEqual(expected, gr.containing_cdu(mark))
 
+    def test_cdu_index(self):
+        cx = FakeCDU('cx', [self.edu1_1])
+        cy = FakeCDU('cy', [cx, self.edu1_2])
+        cz = FakeCDU('cz', [cy, self.edu1_3])
+        gr, ids = self.mk_graph(self.edus1, [], [cx,cy,cz])
+        nids    = dict((k, gr.nodeform(v)) for k, v in ids.items())
+
+        self.assertEqual(3, gr.cdu_depth(nids['e1.1']))
+        self.assertEqual(1, gr.cdu_depth(nids['cy']))
+        self.assertEqual(0, gr.cdu_depth(nids['cz']))
+        self.assertEqual(frozenset(nids[x] for x in
+                                   ['cy', 'cx', 'e1.1', 'e1.2', 'e1.3']),
+                         gr.cdu_members(ids['cz'], deep=True))
+        self.assertEqual(frozenset([nids['cy'], nids['e1.3']]),
+                         gr.cdu_members(ids['cz']))
+
+        # the index follows changes to the graph
+        gr.unlink(nids['cy'], ids['cz'])
+        self.assertEqual(None, gr.containing_cdu(nids['cy']))
+        self.assertEqual(2, gr.cdu_depth(nids['e1.1']))
+        self.assertEqual(frozenset([nids['e1.3']]),
+                         gr.cdu_members(ids['cz'], deep=True))
+
+    def test_apply_delta(self):
+        def structure(gr):
+            annos = dict((x, gr.annotation(x)) for x in gr.nodes())
+            annos.update((x, gr.annotation(x)) for x in gr.hyperedges())
+            links = dict((x, gr.links(x)) for x in gr.hyperedges())
+            return annos, links
+
+        r1  = FakeRelInst('r1', self.edu1_1, self.edu1_2)
+        r2  = FakeRelInst('r2', self.edu1_2, self.edu1_3)
+        c   = FakeCDU('c', [self.edu1_1, self.edu1_2])
+        doc = FakeDocument(self.edus1, [r1, r2], [c])
+        k   = FakeKey('k')
+        doc.fleshout(k)
+        gr  = self.graph_class.from_doc({k:doc}, k)
+        cdu = list(gr.cdus())[0]
+        self.assertEqual(2, len(gr.cdu_members(cdu)))
+
+        # drop r2 (e1.3 is no longer pointed to), point a new relation
+        # from c to e3 (not in the graph yet), and shrink c
+        old_r2, old_c = doc.relations[1], doc.schemas[0]
+        new_r3 = FakeRelInst('r3', c, self.edu2_1)
+        new_c  = FakeCDU('c', [self.edu1_1])
+        doc.relations = [ doc.relations[0], new_r3 ]
+        doc.schemas   = [ new_c ]
+        doc.fleshout(k)
+        gr.apply_delta(added=[new_r3], removed=[old_r2], modified=[new_c])
+
+        expected = self.graph_class.from_doc({k:doc}, k)
+        self.assertEqual(structure(expected), structure(gr))
+        self.assertEqual(expected.cdu_members(cdu), gr.cdu_members(cdu))
+
+    def test_apply_delta_modified_unit(self):
+        r1  = FakeRelInst('r1', self.edu1_1, self.edu1_2)
+        doc = FakeDocument(self.edus1, [r1], [])
+        k   = FakeKey('k')
+        doc.fleshout(k)
+        gr  = self.graph_class.from_doc({k:doc}, k)
+        # editing the same unit more than once (as in a QA loop)
+        for span in [(2,4), (2,3)]:
+            new_e = FakeEDU('e1.2', span=span)
+            doc.units = [ new_e if x.local_id() == 'e1.2' else x
+                          for x in doc.units ]
+            doc.fleshout(k)
+            gr.apply_delta(modified=[new_e])
+            expected = self.graph_class.from_doc({k:doc}, k)
+            self.assertEqual(expected, gr)
+            for n in gr.nodes():
+                self.assertEqual(len(gr.node_attributes(n)),
+                                 len(expected.node_attributes(n)))
+
+    def test_to_matrices(self):
+        try:
+            import scipy.sparse
+        except ImportError:
+            raise unittest.SkipTest('needs scipy')
+        c  = FakeCDU('c', [self.edu1_2, self.edu1_3])
+        r1 = FakeRelInst('r1', self.edu1_1, self.edu1_2, type='Elaboration')
+        r2 = FakeRelInst('r2', c, self.edu2_1, type='Comment')
+        r3 = FakeRelInst('r3', self.edu1_1, self.edu1_2, type='Continuation')
+        gr, ids = self.mk_graph(self.edus1, [r1, r2, r3], [c])
+        mats    = gr.to_matrices(labels=['Comment'])
+
+        expected_nodes = [ gr.nodeform(ids[x]) for x in
+                           ['e1.1', 'e1.2', 'e1.3', 'e3', 'c'] ]
+        self.assertEqual(expected_nodes, mats.nodes)
+        self.assertEqual(4, mats.num_edus)
+        self.assertEqual([None, 'Comment', 'Elaboration'], mats.labels)
+        self.assertEqual([ids['r1'], ids['r2']], mats.relation_edges)
+        self.assertEqual([ids['r3']], mats.skipped_relations)
+        self.assertEqual([[0, 2, 0, 0, 0],
+                          [0, 0, 0, 0, 0],
+                          [0, 0, 0, 0, 0],
+                          [0, 0, 0, 0, 0],
+                          [0, 0, 0, 1, 0]],
+                         mats.relations.toarray().tolist())
+        self.assertEqual([[0, 1, 1, 0, 0]],
+                         mats.cdu_members.toarray().tolist())
+        # eg. in-degrees
+        self.assertEqual([0, 1, 0, 1, 0],
+                         (mats.relations > 0).sum(axis=0).tolist()[0])
+
+    def test_right_frontier_violations(self):
+        c  = FakeCDU('c', [self.edu1_1, self.edu1_2])
+        r1 = FakeRelInst('r1', self.edu1_1, self.edu1_3)
+        r2 = FakeRelInst('r2', c, self.edu1_3)
+        gr, ids = self.mk_graph(self.edus1, [r1, r2], [c])
+        violations = gr.right_frontier_violations()
+        self.assertEqual({gr.nodeform(ids['e1.1']): [ids['r1']]},
+                         dict(violations))
+
+    def test_right_frontier_violations_subordinating(self):
+        # e1.1 is only on the frontier of e1.2 if it points to it
+        # with a subordinating relation
+        for rtype, expected in [ ('Elaboration',  False)
+                               , ('Continuation', True)
+                               ]:
+            r1 = FakeRelInst('r1', self.edu1_1, self.edu1_2, type=rtype)
+            r2 = FakeRelInst('r2', self.edu1_1, self.edu1_3,
+                             type='Continuation')
+            gr, ids = self.mk_graph(self.edus1, [r1, r2], [])
+            violations = gr.right_frontier_violations()
+            self.assertEqual(expected,
+                             gr.nodeform(ids['e1.1']) in violations)
+
+class IndexedGraphTest(GraphTest):
+    graph_class = stac_gr.IndexedGraph
+
+    def test_same_as_graph(self):
+        cx = FakeCDU('cx', [self.edu1_1, self.edu1_2])
+        r1 = FakeRelInst('r1', self.edu1_2, self.edu1_3, type='Elaboration')
+        r2 = FakeRelInst('r2', cx, self.edu2_1)
+        doc = FakeDocument(self.edus1, [r1, r2], [cx])
+        k   = FakeKey('k')
+        doc.fleshout(k)
+        gr1 = stac_gr.Graph.from_doc({k:doc}, k)
+        gr2 = stac_gr.IndexedGraph.from_doc({k:doc}, k)
+        self.assertEqual(gr1, gr2)
+        self.assertEqual(gr1.edus(), gr2.edus())
+        self.assertEqual(gr1.cdus(), gr2.cdus())
+        self.assertEqual(gr1.relations(), gr2.relations())
+        self.assertEqual(gr1.first_widest_dus(), gr2.first_widest_dus())
+        self.assertEqual(gr1.connected_components(),
+                         gr2.connected_components())
+        self.assertEqual(gr1.right_frontier_violations(),
+                         gr2.right_frontier_violations())
+        for e in gr1.hyperedges():
+            self.assertEqual(gr1.links(e), gr2.links(e))
+        gr3 = gr2.copy()
+        self.assertTrue(isinstance(gr3, stac_gr.IndexedGraph))
+        self.assertEqual(gr2, gr3)
+
 # FIXME: the tests below should be shuffled into the fixture above
 
 edu1 = FakeEDU('e1')
@@ -197,6 +356,73 @@ def test_embedded_cdu_head():
     assert deep_heads[ids['c1']] == gr.cdu_head(ids['c1'])
     assert deep_heads[ids['c1']] == deep_heads[ids['c2']]
 
+    report = gr.cdu_heads_report()
+    assert report[ids['c2']].head      == ids['c1']
+    assert report[ids['c2']].deep_head == ids['e1']
+    assert report[ids['c2']].depth     == 0
+    assert report[ids['c1']].depth     == 1
+    assert not report[ids['c1']].multiheaded
+
+def test_cdu_heads_report_multiheaded():
+    doc  = FakeDocument([edu1, edu2, edu3], [rel1], [cdu1])
+    k    = FakeKey('cdu_head_test')
+    doc.fleshout(k)
+    gr   = stac_gr.Graph.from_doc({k:doc}, k)
+    ids  = graph_ids(gr)
+    info = gr.cdu_heads_report()[ids['c1']]
+    assert info.multiheaded
+    assert info.candidates == [ids['e1'], ids['e3']]
+    assert info.head == info.deep_head == ids['e1']
+
+def test_without_cdus():
+    doc  = FakeDocument([edu1, edu2, edu3, edu4],
+                        [rel1, rel2, rel3],
+                        [cdu1, cdu2])
+    k    = FakeKey('without_cdus_test')
+    doc.fleshout(k)
+    gr   = stac_gr.Graph.from_doc({k:doc}, k)
+    ids  = graph_ids(gr)
+    before  = gr.copy()
+    schemas = list(doc.schemas)
+    r_c1_e4 = gr.annotation(ids['r-c1-e4'])
+    gr2  = gr.without_cdus()
+    assert not gr2.cdus()
+    assert gr2.links(ids['r-c1-e4']) == [ids['e1'], ids['e4']]
+    assert gr2.annotation(ids['r-c1-e4']).source is gr.annotation(ids['e1'])
+    assert gr2.doc.schemas == []
+    assert gr2.corpus[k] is gr2.doc
+    # the original graph and document are left alone
+    assert gr == before
+    assert gr.links(ids['r-c1-e4']) == [gr.mirror(ids['c1']), ids['e4']]
+    assert r_c1_e4.source is gr.annotation(ids['c1'])
+    assert r_c1_e4.span.t1 == 'c1'
+    assert doc.schemas == schemas
+    # and unchanged annotations are shared
+    assert gr2.annotation(ids['r-e1-e2']) is gr.annotation(ids['r-e1-e2'])
+    assert gr2.annotation(ids['e1']) is gr.annotation(ids['e1'])
+
+def test_without_cdus_nested_relations():
+    # a relation whose source is a relation on a CDU
+    rel4 = FakeRelInst('r-r3-e3', rel3, edu3)
+    doc  = FakeDocument([edu1, edu2, edu3, edu4],
+                        [rel1, rel2, rel3, rel4],
+                        [cdu1, cdu2])
+    k    = FakeKey('without_cdus_nested_test')
+    doc.fleshout(k)
+    gr   = stac_gr.Graph.from_doc({k:doc}, k)
+    ids  = graph_ids(gr)
+    gr2  = gr.without_cdus()
+    r3   = gr2.annotation(ids['r-c1-e4'])
+    r4   = gr2.annotation(ids['r-r3-e3'])
+    assert r3 is not gr.annotation(ids['r-c1-e4'])
+    assert r4.source is r3
+    assert r4.span.t1 == 'r-c1-e4'
+    assert gr.annotation(ids['r-r3-e3']).source is\
+            gr.annotation(ids['r-c1-e4'])
+    for r in gr2.doc.relations:
+        assert r.source in gr2.doc.units or r.source in gr2.doc.relations
+        assert r.target in gr2.doc.units or r.target in gr2.doc.relations
+
 def test_first_widest_dus_simple():
     edu1 = FakeEDU('e1',span=(1,2))
     edu2 = FakeEDU('e2',span=(1,3))
@@ -236,3 +462,366 @@ def test_first_widest_dus():
     got      = gr.first_widest_dus()
     expected = ['c3', 'c1','e2','e1','e3', 'c2', 'e4', 'e5' ]
     assert got == [ ids[x] for x in expected ]
+    rank     = gr.first_widest_rank()
+    assert [ rank[ids[x]] for x in expected ] == range(len(expected))
+
+    # the ordering is remembered, but forgotten when the graph changes
+    got.reverse()
+    assert gr.first_widest_dus() == [ ids[x] for x in expected ]
+    gr.del_node(ids['e5'])
+    assert ids['e5'] not in gr.first_widest_rank()
+
+def test_from_corpus():
+    corpus_ = {}
+    for name in ['d1', 'd2', 'd3']:
+        doc = FakeDocument([edu1, edu2, edu3, edu4],
+                           [rel1, rel2, rel3],
+                           [cdu1, cdu2])
+        k   = FakeKey(name)
+        doc.fleshout(k)
+        corpus_[k] = doc
+    for jobs in [1, 2]:
+        graphs = stac_gr.IndexedGraph.from_corpus(corpus_, jobs=jobs)
+        assert sorted(graphs) == sorted(corpus_)
+        for k, gr in graphs.items():
+            expected = stac_gr.IndexedGraph.from_doc(corpus_, k)
+            assert gr == expected
+            assert gr.doc is corpus_[k]
+            # annotations are the ones in our corpus, not copies
+            for x in gr.nodes():
+                anno = gr.annotation(x)
+                assert any(anno is y for y in
+                           corpus_[k].units + corpus_[k].relations +
+                           corpus_[k].schemas)
+
+def test_graph_data():
+    doc  = FakeDocument([edu1, edu2, edu3, edu4],
+                        [rel1, rel2, rel3],
+                        [cdu1, cdu2])
+    k    = FakeKey('graph_data_test')
+    doc.fleshout(k)
+    corpus_ = {k:doc}
+    gr   = stac_gr.Graph.from_doc(corpus_, k)
+    gr2  = stac_gr.Graph.from_data(corpus_, k, gr.to_data())
+    assert gr == gr2
+
+    # relations pointing to CDU heads instead of the CDUs themselves
+    gr3  = gr.without_cdus()
+    gr4  = stac_gr.Graph.from_data(corpus_, k, gr3.to_data())
+    assert gr3.relations() == gr4.relations()
+    for e in gr4.relations():
+        assert gr3.links(e) == gr4.links(e)
+        anno3 = gr3.annotation(e)
+        anno4 = gr4.annotation(e)
+        assert anno4.span.t1 == anno3.span.t1
+        assert anno4.span.t2 == anno3.span.t2
+        assert anno4.target.local_id() == anno3.span.t2
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        builds = []
+        def build(corpus, key):
+            builds.append(key)
+            return stac_gr.Graph.from_doc(corpus, key).without_cdus(sloppy=True)
+        cache = educe.graph.GraphCache(tmpdir)
+        cold  = cache.get(stac_gr.Graph, corpus_, k, 'nocdu', build)
+        warm  = cache.get(stac_gr.Graph, corpus_, k, 'nocdu', build)
+        assert len(builds) == 1
+        for gr5 in [cold, warm]:
+            assert gr5.relations() == gr3.relations()
+            assert not gr5.cdus()
+        # the cached graph is the same as the one it was built from,
+        # down to the modified view of the document (retargeted
+        # relations are copies, so we compare them by id and span)
+        def shape(gr_):
+            def attrs(xs):
+                xs = dict(xs)
+                anno = xs.pop('annotation', None)
+                if anno is not None:
+                    xs['annotation'] = (anno.local_id(), str(anno.span))
+                return sorted(xs.items())
+            nodes = sorted((n, attrs(gr_.node_attributes(n)))
+                           for n in gr_.nodes())
+            edges = sorted((e, attrs(gr_.edge_attributes(e)),
+                            sorted(gr_.links(e))) for e in gr_.hyperedges())
+            return nodes, edges
+        assert shape(warm) == shape(cold)
+        assert len(warm.doc.schemas) == len(cold.doc.schemas)
+        assert warm.doc is warm.corpus[k]
+        assert corpus_[k] is doc
+        def endpoints(gr_):
+            return sorted((x.local_id(), x.source.local_id(),
+                           x.target.local_id()) for x in gr_.doc.relations)
+        assert endpoints(warm) == endpoints(cold)
+        for e in warm.relations():
+            anno = warm.annotation(e)
+            assert anno in warm.doc.relations
+            assert anno.target.local_id() == anno.span.t2
+        # the plain graph is cached separately
+        assert cache.get(stac_gr.Graph, corpus_, k) == gr
+        # changes to the document invalidate the cache
+        doc.relations = doc.relations[:1]
+        gr6 = cache.get(stac_gr.Graph, corpus_, k, 'nocdu', build)
+        assert len(builds) == 2
+        assert len(gr6.relations()) == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_frontier_index():
+    points   = { 'a' : None, 'b' : 'a', 'c' : 'b', 'd' : 'a'
+               , 'x' : 'y',  'y' : 'x', 'z' : 'x' } # cycle
+    frontier = stac_gr.FrontierIndex(points)
+    assert frontier.is_on_frontier('c', 'a')
+    assert frontier.is_on_frontier('c', 'c')
+    assert not frontier.is_on_frontier('c', 'd')
+    assert not frontier.is_on_frontier('a', 'c')
+    assert list(frontier.frontier('c')) == ['c', 'b', 'a']
+    assert frontier.is_on_frontier('z', 'y')
+    assert not frontier.is_on_frontier('z', 'a')
+    assert list(frontier.frontier('z')) == ['z', 'x', 'y']
+
+def test_incremental_right_frontier():
+    edus = [ FakeEDU('e%d' % i, span=(i*2, i*2+1)) for i in range(1,5) ]
+    e1, e2, e3, e4 = edus
+    c1   = FakeCDU('c1', [e1, e2])
+    c2   = FakeCDU('c2', [c1, e3, e4])
+    doc  = FakeDocument(edus, [FakeRelInst('r', e2, e3)], [c1, c2])
+    k    = FakeKey('incremental_rf')
+    doc.fleshout(k)
+    gr   = stac_gr.Graph.from_doc({k:doc}, k)
+    ids  = nodeform_graph_ids(gr)
+    batch = gr.frontier_index().frontier(ids['e4'])
+
+    incr = stac_gr.IncrementalRightFrontier()
+    for e in edus:
+        incr.push_edu(e.local_id())
+    incr.attach('e2', 'e3', 'Continuation')
+    assert incr.frontier() == ['e4']
+    incr.add_cdu('c1', ['e1', 'e2'])
+    incr.add_cdu('c2', ['c1', 'e3', 'e4'])
+    assert [ ids[x] for x in incr.frontier() ] == list(batch)
+    assert incr.frontier() == ['e4', 'c2']
+
+    # subordinating relations bring in their source
+    incr.attach('e3', 'e4', 'Elaboration')
+    assert incr.frontier() == ['e4', 'e3', 'c2']
+    assert incr.on_frontier('e3')
+    assert not incr.on_frontier('e1')
+    incr.push_edu('e5')
+    assert incr.frontier() == ['e5']
+    assert incr.previous_frontier() == ['e4', 'e3', 'c2']
+
+    # same again in batch, now that is_subordinating sees relations
+    doc2 = FakeDocument(edus,
+                        [ FakeRelInst('r1', e2, e3, 'Continuation')
+                        , FakeRelInst('r2', e3, e4, 'Elaboration')
+                        ],
+                        [c1, c2])
+    k2   = FakeKey('incremental_rf_sub')
+    doc2.fleshout(k2)
+    gr2  = stac_gr.Graph.from_doc({k2:doc2}, k2)
+    ids2 = nodeform_graph_ids(gr2)
+    batch2 = gr2.frontier_index().frontier(ids2['e4'])
+    assert [ ids2[x] for x in incr.previous_frontier() ] == list(batch2)
+
+def test_twins():
+    corpus_ = {}
+    for stage, type in [ ('discourse', 'Segment'), ('units', 'Offer') ]:
+        doc = FakeDocument([ FakeEDU('e1', type=type)
+                           , FakeEDU('e2', type=type)
+                           ], [], [])
+        k   = corpus.FileId('twin_test', '01', stage, 'bob')
+        doc.fleshout(k)
+        corpus_[k] = doc
+    dkey  = corpus.FileId('twin_test', '01', 'discourse', 'bob')
+    ukey  = corpus.FileId('twin_test', '01', 'units',     'bob')
+    e1, e2 = corpus_[dkey].units
+    stray = FakeEDU('e3')
+    stray.origin = dkey
+    expected = [ corpus_[ukey].units[0], corpus_[ukey].units[1], None ]
+    assert stac.twins(corpus_, [e1, e2, stray]) == expected
+    assert [ stac.twin(corpus_, x) for x in [e1, e2, stray] ] == expected
+    index = stac.TwinIndex(corpus_)
+    assert index.twin(corpus_[ukey].units[1], 'discourse') is e2
+    assert index.twin(e1, 'unannotated') is None
+
+def test_turn_table():
+    text  = u'1 : Bob : hi there\n2 : Alice : anyone got wheat?'
+    def turn(start, end, speaker):
+        return annotation.Unit('t%d' % start, annotation.Span(start, end),
+                               'Turn', {'Emitter': speaker}, {})
+    turn1 = turn(0, 18, 'Bob')
+    turn2 = turn(19, len(text), 'Alice')
+    edu   = FakeEDU('e1', span=(30, 36))
+    doc   = annotation.Document([turn2, edu, turn1], [], [], text)
+    table = stac.turn_table(doc)
+    assert [ x.turn for x in table ] == [turn1, turn2]
+    info  = table.infos[1]
+    assert info.prefix_len == len('2 : Alice : ')
+    assert doc.text(info.body_span) == u'anyone got wheat?'
+    assert doc.text(info.body_span) == stac.split_turn_text(text[19:])[1]
+    assert (info.speaker, info.identifier) == ('Alice', '2')
+    assert table.enclosing(edu.span) is info
+    assert table.enclosing(annotation.Span(10, 25)) is None
+    assert stac.turn_table(doc) is table
+    doc.units = doc.units[:2]
+    assert [ x.turn for x in stac.turn_table(doc) ] == [turn2]
+    # replacing a turn in place needs an explicit refresh
+    turn3 = turn(19, len(text), 'Charlie')
+    doc.units[0] = turn3
+    assert [ x.speaker for x in stac.turn_table(doc) ] == ['Alice']
+    table = stac.turn_table(doc, refresh=True)
+    assert [ x.speaker for x in table ] == ['Charlie']
+
+    # repeated lookups do not go through the units again
+    class CountingList(list):
+        def __init__(self, xs):
+            list.__init__(self, xs)
+            self.scans = 0
+        def __iter__(self):
+            self.scans += 1
+            return list.__iter__(self)
+    doc.units = CountingList(doc.units)
+    table = stac.turn_table(doc)
+    scans = doc.units.scans
+    for _ in range(10):
+        assert stac.turn_table(doc) is table
+    assert doc.units.scans == scans
+
+    # a turn without the usual prefix does not spoil the others
+    doc   = annotation.Document([turn1, turn(10, 18, 'Bob')], [], [], text)
+    info1, info2 = stac.turn_table(doc).infos
+    assert info1.well_formed and info1.identifier == '1'
+    assert not info2.well_formed and info2.identifier is None
+    assert info2.prefix_len == 0
+    assert doc.text(info2.body_span) == u'hi there'
+
+def test_candidate_pairs():
+    try:
+        from educe.stac import pairs
+    except ImportError:
+        raise unittest.SkipTest('needs numpy')
+    # two dialogues: turns by Bob, Alice, Bob; then Alice
+    text  = u'1 : Bob : a b\n2 : Alice : c\n3 : Bob : d\n4 : Alice : e f'
+    def unit(local_id, start, end, type='Segment', features=None):
+        return annotation.Unit(local_id, annotation.Span(start, end),
+                               type, features or {}, {})
+    units = [ unit('d1', 0, 39, 'Dialogue')
+            , unit('d2', 40, len(text), 'Dialogue')
+            , unit('t1', 0, 13, 'Turn', {'Emitter': 'Bob'})
+            , unit('t2', 14, 27, 'Turn', {'Emitter': 'Alice'})
+            , unit('t3', 28, 39, 'Turn', {'Emitter': 'Bob'})
+            , unit('t4', 40, len(text), 'Turn', {'Emitter': 'Alice'})
+            , unit('a', 10, 11), unit('b', 12, 13), unit('c', 26, 27)
+            , unit('d', 38, 39), unit('e', 52, 53), unit('f', 54, 55)
+            ]
+    doc = annotation.Document(units, [], [], text)
+    def ids(p):
+        return [ (x.local_id(), y.local_id()) for x, y in p ]
+
+    p = pairs.candidate_pairs(doc)
+    assert ids(p) == [ ('a','b'), ('a','c'), ('a','d'), ('b','c'),
+                       ('b','d'), ('c','d'), ('e','f') ]
+    assert list(p.edu_dist)  == [1, 2, 3, 1, 2, 1, 1]
+    assert list(p.turn_dist) == [0, 1, 2, 1, 2, 1, 0]
+    assert list(p.char_dist) == [2, 16, 28, 14, 26, 12, 2]
+
+    p = pairs.candidate_pairs(doc, window=1, same_speaker=False)
+    assert ids(p) == [ ('b','c'), ('c','d') ]
+    p = pairs.candidate_pairs(doc, same_speaker=True, directed=True)
+    assert sorted(ids(p)) == sorted([ ('a','b'), ('a','d'), ('b','d'),
+                                      ('e','f'), ('b','a'), ('d','a'),
+                                      ('d','b'), ('f','e') ])
+
+    # only pairs on the right frontier of the EDU before the later one
+    def rel(local_id, src, tgt, type):
+        return annotation.Relation(local_id, annotation.RelSpan(src, tgt),
+                                   type, {}, {})
+    rels  = [ rel('r1', 'a', 'b', 'Elaboration')
+            , rel('r2', 'b', 'c', 'Continuation')
+            ]
+    k     = FakeKey('candidate_pairs_graph')
+    doc2  = annotation.Document(units, rels, [], text)
+    doc2.fleshout(k)
+    graph = stac_gr.Graph.from_doc({k:doc2}, k)
+    p = pairs.candidate_pairs(doc2, graph=graph)
+    assert ids(p) == [ ('a','b'), ('a','c'), ('b','c'), ('c','d'),
+                       ('e','f') ]
+
+    # EDUs with no known speaker are left out either way
+    units[4] = unit('t3', 28, 39, 'Turn')
+    doc3 = annotation.Document(units, [], [], text)
+    p = pairs.candidate_pairs(doc3, same_speaker=False)
+    assert ids(p) == [ ('a','c'), ('b','c') ]
+    p = pairs.candidate_pairs(doc3, same_speaker=True)
+    assert ids(p) == [ ('a','b'), ('e','f') ]
+
+def test_features():
+    try:
+        from educe.stac import features
+    except ImportError:
+        raise unittest.SkipTest('needs numpy and scipy')
+    text  = u'1 : Bob : anyone got wheat\n2 : Alice : no sorry'
+    def unit(local_id, start, end, type='Segment', features=None):
+        return annotation.Unit(local_id, annotation.Span(start, end),
+                               type, features or {}, {})
+    units = [ unit('t1', 0, 26, 'Turn', {'Emitter': 'Bob'})
+            , unit('t2', 27, len(text), 'Turn', {'Emitter': 'Alice'})
+            , unit('e1', 10, 26, 'Question')
+            , unit('e2', 39, 41, 'Refusal')
+            , unit('e3', 42, 47, 'Other')
+            ]
+    rels  = [ annotation.Relation('r1', annotation.RelSpan('e1', 'e2'),
+                                  'Question-answer_pair', {}, {}) ]
+    k     = FakeKey('features_test')
+    doc   = annotation.Document(units, rels, [], text)
+    doc.fleshout(k)
+    corpus_ = {k: doc}
+
+    vocab = features.FeatureVocabulary()
+    edus  = features.edu_features(corpus_, vocabulary=vocab)
+    assert edus.rows == [ (k, 'e1'), (k, 'e2'), (k, 'e3') ]
+    assert edus.matrix.shape == (3, len(vocab))
+    def value(m, row, name):
+        return m.matrix[row, m.vocabulary.index(name)]
+    assert value(edus, 0, 'act=Question') == 1
+    assert value(edus, 0, 'word=wheat') == 1
+    assert value(edus, 1, 'speaker=Alice') == 1
+    assert value(edus, 2, 'turn_position') == 1
+    assert value(edus, 2, 'turn_last') == 1
+    assert value(edus, 1, 'turn_last') == 0
+
+    pairs = features.pair_features(corpus_, vocabulary=vocab)
+    assert [ r[1:] for r in pairs.rows ] ==\
+            [ ('e1', 'e2'), ('e1', 'e3'), ('e2', 'e3') ]
+    labels = [ pairs.label_vocabulary.names[i] for i in pairs.labels ]
+    assert labels == [ 'Question-answer_pair',
+                       features.UNRELATED, features.UNRELATED ]
+    assert value(pairs, 0, 'acts=Question>Refusal') == 1
+    assert value(pairs, 2, 'same_turn') == 1
+    assert value(pairs, 1, 'edu_dist') == 2
+
+    # the same in parallel (over more than one document)
+    k2    = FakeKey('features_test2')
+    doc2  = annotation.Document(copy.deepcopy(units), copy.deepcopy(rels),
+                                [], text)
+    doc2.fleshout(k2)
+    corpus2 = {k: doc, k2: doc2}
+    for extract in [features.edu_features, features.pair_features]:
+        serial   = extract(corpus2, jobs=1)
+        parallel = extract(corpus2, jobs=2)
+        assert parallel.rows == serial.rows
+        assert parallel.vocabulary.names == serial.vocabulary.names
+        assert (parallel.matrix != serial.matrix).nnz == 0
+
+    # a frozen vocabulary leaves out features it does not know
+    vocab.freeze()
+    size = len(vocab)
+    doc.units[2] = unit('e1', 10, 26, 'Offer')
+    doc.fleshout(k)
+    edus = features.edu_features(corpus_, vocabulary=vocab)
+    assert len(vocab) == size
+    assert edus.matrix.shape == (3, size)
+    assert 'act=Offer' not in vocab
+    assert value(edus, 0, 'act=Question') == 0
+    assert value(edus, 0, 'word=wheat') == 1
@@ -8,8 +8,14 @@ Tests for educe
 """
 
 import copy
+import cPickle as pickle
+import os
+import shutil
+import stat
+import tempfile
 import pygraph.classes.hypergraph as gr
 import educe.graph as educe
+import educe.glozz as glozz
 import sys
 from pygraph.algorithms import accessibility, traversal, searching
 from educe.annotation import *
@@ -77,6 +83,167 @@ def test_members():
         assert sp.char_start >= doc_sp.char_start
         assert sp.char_end   <= doc_sp.char_end
 
+# ---------------------------------------------------------------------
+# glozz
+# ---------------------------------------------------------------------
+
+class GlozzPatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.aa     = os.path.join(self.tmpdir, 'example.aa')
+        shutil.copy('example-units.aa', self.aa)
+        with open(self.aa, 'rb') as f:
+            self.orig_bytes = f.read()
+        self.orig = glozz.read_annotation_file(self.aa)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_patch(self):
+        u_del, u_edit, u_keep = self.orig.units[1:4]
+        new_unit = Unit('patch_1', Span(3,5), 'Segment', {'Comments':'hi'},
+                        metadata={'author':'patch'})
+        glozz.patch_annotation_file(self.aa,
+                                    additions=[new_unit],
+                                    deletions=[u_del.local_id()],
+                                    feature_edits={u_edit.local_id():{'Foo':'bar'}})
+        doc = glozz.read_annotation_file(self.aa)
+        ids = [ u.local_id() for u in doc.units ]
+        self.assertEqual(len(self.orig.units), len(doc.units))
+        self.assertFalse(u_del.local_id() in ids)
+        self.assertEqual(ids[-1], 'patch_1')
+        self.assertEqual(doc.units[-1].span, new_unit.span)
+        edited = [ u for u in doc.units if u.local_id() == u_edit.local_id() ][0]
+        self.assertEqual(edited.features['Foo'], 'bar')
+        self.assertEqual(len(doc.relations), len(self.orig.relations))
+
+        # untouched annotations are copied through verbatim
+        with open(self.aa, 'rb') as f:
+            new_bytes = f.read()
+        marker = '<unit id="%s">' % u_keep.local_id()
+        start  = self.orig_bytes.index(marker)
+        end    = self.orig_bytes.index('</unit>', start)
+        self.assertTrue(self.orig_bytes[start:end] in new_bytes)
+        self.assertFalse('\n' in new_bytes.replace('\r\n', ''))
+
+    def test_patch_unknown_id(self):
+        self.assertRaises(glozz.GlozzException,
+                          glozz.patch_annotation_file, self.aa,
+                          deletions=['no_such_id'])
+
+    def test_write_annotation_files(self):
+        outdir = os.path.join(self.tmpdir, 'out')
+        docs   = dict((os.path.join(outdir, d, 'x.aa'), self.orig)
+                      for d in ['a', 'b', 'c'])
+        report = glozz.write_annotation_files(docs, jobs=2)
+        self.assertEqual(sorted(report.written), sorted(docs))
+        self.assertEqual(report.skipped, [])
+        for f in docs:
+            doc = glozz.read_annotation_file(f)
+            self.assertEqual(len(doc.units), len(self.orig.units))
+
+        # second time round, nothing to do
+        report = glozz.write_annotation_files(docs)
+        self.assertEqual(report.written, [])
+        self.assertEqual(sorted(report.skipped), sorted(docs))
+
+    def test_write_annotation_files_mode(self):
+        outdir   = os.path.join(self.tmpdir, 'out')
+        new_file = os.path.join(outdir, 'new.aa')
+        old_file = os.path.join(outdir, 'old.aa')
+        os.makedirs(outdir)
+        with open(old_file, 'wb') as f:
+            f.write('not glozz yet')
+        os.chmod(old_file, 0640)
+        umask = os.umask(0022)
+        try:
+            glozz.write_annotation_files({ new_file : self.orig
+                                         , old_file : self.orig })
+        finally:
+            os.umask(umask)
+        def mode(f):
+            return stat.S_IMODE(os.stat(f).st_mode)
+        self.assertEqual(mode(new_file), 0644)
+        self.assertEqual(mode(old_file), 0640)
+
+BROKEN_GLOZZ = """<?xml version='1.0' encoding='utf-8'?>
+<annotations>
+<unit id="u1">
+<characterisation><type>Segment</type><featureSet/></characterisation>
+<positioning><start><singlePosition index="5"/></start><end><singlePosition index="2"/></end></positioning>
+</unit>
+<unit id="u1">
+<characterisation><type>Segment</type><featureSet/></characterisation>
+<positioning><start><singlePosition index="1"/></start><end><singlePosition index="2"/></end></positioning>
+</unit>
+<relation id="r1">
+<characterisation><type>Elaboration</type><featureSet/></characterisation>
+<positioning><term id="u1"/><term id="u9"/></positioning>
+</relation>
+<schema id="s1">
+<characterisation><type>Complex_discourse_unit</type><featureSet/></characterisation>
+<positioning><embedded-unit id="r1"/></positioning>
+</schema>
+</annotations>
+"""
+
+def test_validate_annotation_file():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'broken.aa')
+        with open(path, 'wb') as f:
+            f.write(BROKEN_GLOZZ)
+        problems = glozz.validate_annotation_file(path)
+        got = sorted((p.line, p.message.split()[0]) for p in problems)
+        assert got == [ (5, 'unit')        # start after end
+                      , (7, 'duplicate')
+                      , (13, 'dangling')
+                      , (17, '<embedded-unit>')
+                      ]
+        try:
+            glozz.read_annotation_file(path, validate=True)
+            assert False # should not get here
+        except glozz.GlozzValidationException as e:
+            assert len(e.problems) == len(problems)
+        # but a healthy file is fine
+        assert glozz.validate_annotation_file('example-discourse.aa') == []
+        doc = glozz.read_annotation_file('example-discourse.aa', validate=True)
+        assert len(doc.relations) > 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_mapped_text():
+    txt = u'tr\u00e8s \u0153uvre \u00e0 \u4e2d\u6587 plain ascii ' * 7
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'x.ac')
+        with open(path, 'wb') as f:
+            f.write(txt.encode('utf-8'))
+        mtxt = glozz.MappedText(path, block_size=5)
+        assert len(mtxt) == len(txt)
+        assert mtxt[:] == txt
+        assert mtxt[-3] == txt[-3]
+        for start in range(0, len(txt), 7):
+            for end in range(start, len(txt) + 3, 11):
+                assert mtxt[start:end] == txt[start:end]
+        # copies and pickles work like any other text
+        for mtxt2 in [ copy.deepcopy(mtxt), copy.copy(mtxt),
+                       pickle.loads(pickle.dumps(mtxt)) ]:
+            assert mtxt2[:] == txt
+            mtxt2.close()
+        mtxt.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+def test_mapped_document_copy():
+    doc  = glozz.read_annotation_file('example-discourse.aa',
+                                      'example-discourse.ac', mmap_text=True)
+    text = doc.text()
+    for doc2 in [ copy.deepcopy(doc), pickle.loads(pickle.dumps(doc)) ]:
+        assert doc2.text() == text
+        assert [ doc2.text(x.span) for x in doc2.units ] ==\
+               [ doc.text(x.span)  for x in doc.units ]
+
 # ---------------------------------------------------------------------
 # graph
 # ---------------------------------------------------------------------
@@ -208,6 +375,71 @@ def test_copy():
     assert gr4.edus() == xset2
     assert gr4.cdus() == set(['X1', 'X2'])
 
+def test_connected_components():
+    """
+    things connected via a relation or CDU edge are also
+    connected to its mirror node
+    """
+    gr = FakeGraph()
+    gr.add_edus('a', 'b', 'c', 'x1', 'x2', 'y', 'z')
+    gr.add_rel('ab', 'a', 'b')
+    gr.add_rel('ab-c', 'ab', 'c') # relation on relation
+    gr.add_cdu('X', ['x1', 'x2'])
+    gr.add_rel('y-X', 'y', 'X')   # relation to CDU
+    expected = frozenset([ frozenset(['a', 'b', 'c', 'ab', 'ab-c'])
+                         , frozenset(['x1', 'x2', 'X', 'y', 'y-X'])
+                         , frozenset(['z'])
+                         ])
+    assert gr.connected_components() == expected
+
+def test_split_components():
+    gr = FakeGraph()
+    gr.add_edus(1, 2, 3, 4, 5)
+    gr.add_rel('1.2', 1, 2)
+    gr.add_cdu('X', [3, 4])
+    gr.add_rel('2.X', 2, 'X')
+    parts = gr.split_components()
+    assert len(parts) == 2
+    assert [ p.nodes() for p in parts ] ==\
+            [ gr.copy(p.nodes()).nodes() for p in parts ]
+    big, small = parts
+    assert big.relations() == set(['1.2', '2.X'])
+    assert big.cdus()      == set(['X'])
+    assert big.links('X')  == ['3', '4']
+    assert small.edus()    == set(['5'])
+
+class FakeIndexedGraph(FakeGraph, educe.IndexedHypergraph):
+    """
+    Stand-in for educe.graph.IndexedGraph
+    """
+    pass
+
+def test_indexed_backend():
+    def build(gr):
+        gr.add_edus(*range(1,6))
+        gr.add_rel('1.2', 1, 2)
+        gr.add_rel('2.3', 2, 3)
+        gr.add_cdu('X', [4,5])
+        gr.add_rel('3.X', 3, 'X')
+        return gr
+    gr1 = build(FakeGraph())
+    gr2 = build(FakeIndexedGraph())
+    assert gr1 == gr2
+    assert gr1.edus() == gr2.edus()
+    assert gr1.cdus() == gr2.cdus() == set(['X'])
+    assert gr2.links('X') == ['4', '5']
+    assert sorted(gr2.neighbors('2')) == ['1', '3']
+    assert gr1.copy(nodeset=['1','2']) == gr2.copy(nodeset=['1','2'])
+    assert gr1.connected_components() == gr2.connected_components()
+
+    # changing types and deleting things keeps the type index in sync
+    gr2.add_node_attribute('1', ('type', 'CDU'))
+    assert '1' not in gr2.edus()
+    assert '1' in gr2._candidate_nodes('CDU')
+    gr2.del_edge('X')
+    gr2.del_node('X')
+    assert gr2.cdus() == set()
+    assert gr2.links('4') == []
 
 # TODO: is this test legitimate?
 #gr_fancy_cdus = FakeGraph()